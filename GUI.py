@@ -3,13 +3,17 @@ from tkinter.ttk import *
 from queue import *
 import cv2
 import numpy as np
-from main import main, show_images
+from main import main, show_images, selectStrategy, AUTO
+from strategies import strategyNames
+from cache import FusionCache
+from fuse import FusionSession
 from PIL import Image, ImageTk
 import threading
 from pywt import families
 from tkinter import filedialog
 import math
 import os
+import traceback
 
 class Window(Frame):
 	def __init__(self, master=None):
@@ -70,6 +74,10 @@ class Window(Frame):
 		fusion.grid(column=0, row=2)
 		self.fusion = fusion
 		
+		cancel = Button(self, text = "Cancel", command=self.cancelFusion)
+		cancel.grid(column=1, row=2)
+		self.cancel = cancel
+		
 		text = Text(self, width=70, height=15)
 		text.grid(column=0, row=3)
 		self.text=text
@@ -77,7 +85,7 @@ class Window(Frame):
 		self.progressbar = Progressbar(self, orient=HORIZONTAL, mode='indeterminate',length=100)
 		self.progressbar.grid(column=1, row=3)
 
-		options = ["All", "Min", "Max", "Mean", "Entropy", "MACD", "Edge", "Deviation"]
+		options = ["All", AUTO] + strategyNames()
 		
 		self.variable = StringVar(self)
 		self.variable.set(options[0])
@@ -97,8 +105,42 @@ class Window(Frame):
 		self.waveletDropdown = OptionMenu(self, self.waveletVar, wavelets[1], *wavelets)
 		self.waveletDropdown.grid(column=4, row=1)
 		
+		# Color space of the luminance fusion : only the luminance of the RGB image is
+		# fused with the IR image, which keeps the colors of the RGB image
+		self.dictColors = {"BGR" : None, "YCrCb" : "ycrcb", "HSV" : "hsv"}
+		
+		self.colorVar = StringVar(self)
+		self.colorVar.set("BGR")
+		
+		self.colorDropdown = OptionMenu(self, self.colorVar, "BGR", *self.dictColors)
+		self.colorDropdown.grid(column=5, row=1)
+		
+		# Preview mode : every change of strategy or wavelet fuses a downscaled proxy
+		# of the pair at once, the full resolution fusion being started by the button
+		self.previewVar = BooleanVar(self)
+		self.previewVar.set(True)
+		
+		preview = Checkbutton(self, text = "Preview", variable=self.previewVar, command=self.updatePreview)
+		preview.grid(column=2, row=2)
+		self.preview = preview
+		
+		self.variable.trace_add('write', lambda *args: self.updatePreview())
+		self.waveletVar.trace_add('write', lambda *args: self.updatePreview())
+		self.colorVar.trace_add('write', lambda *args: self.showImg())
+		self.previewSession = None
+		self.previewTask = None
+		
 		self.queue = Queue()
 		
+		# The fusion thread posts its results to the queue, then wakes up the UI with
+		# this event, instead of the queue being polled
+		self.bind("<<FusionProgress>>", self.process_queue)
+		self.task = None
+		self.Results, self.Titles = [], []
+		
+		# Fused images and metrics already computed, kept between runs of the GUI
+		self.cache = FusionCache()
+		
 		self.rgb_path = ""
 		self.ir_path = ""
 	
@@ -130,30 +172,79 @@ class Window(Frame):
 			self.canvasIR.create_image(0, 0, image=IR, anchor=NW)
 			self.canvasIR.image = IR
 		
+		# The proxies of the previous pair are not valid anymore
+		self.previewSession = None
+		self.updatePreview()
+	
+	def updatePreview(self):
+		if not (self.previewVar.get() and self.rgb_path and self.ir_path):
+			return
+		
+		# The proxies are fused on a thread (with All or Auto, every strategy is), only the
+		# images are shown by the UI. A new preview replaces the running one.
+		if self.previewTask is not None:
+			self.previewTask.cancel()
+		
+		self.previewTask = PreviewTask(self.rgb_path, self.ir_path, self.queue, self.variable.get(), self.waveletVar.get(),
+									   self.dictWavelets[self.waveletVar.get()], self.previewSession, self.notify,
+									   self.previewTask, self.dictColors[self.colorVar.get()])
+		self.previewTask.start()
+		
 	def startFusion(self):
 		if (self.rgb_path and self.ir_path):
 			self.progressbar.start()
 			
+			# A new request replaces the running one : it is cancelled, and the new
+			# task waits for it to stop instead of competing with it
+			if self.task is not None:
+				self.task.cancel()
 			
-			ThreadedTask(self.rgb_path, self.ir_path, self.queue, self.variable.get(), 
-						 self.waveletVar.get(), self.dictWavelets[self.waveletVar.get()]).start()
-			self.master.after(2000, self.process_queue)
+			self.Results, self.Titles = [], []
+			self.task = ThreadedTask(self.rgb_path, self.ir_path, self.queue, self.variable.get(), 
+									 self.waveletVar.get(), self.dictWavelets[self.waveletVar.get()], self.cache,
+									 self.notify, self.task, self.dictColors[self.colorVar.get()])
+			self.task.start()
 
-	def process_queue(self):
+	def cancelFusion(self):
+		if self.task is not None:
+			self.task.cancel()
+	
+	def notify(self):
+		"""
+		Wake up the UI from the fusion thread
+		"""
 		try:
-			arr, Results, Titles = self.queue.get(0)
+			self.event_generate("<<FusionProgress>>", when="tail")
+		except TclError:
+			# The window was closed
+			pass
+	
+	def process_queue(self, event = None):
+		while True:
+			try:
+				task, arr, Results, Titles, done = self.queue.get_nowait()
+			except Empty:
+				break
+			
+			# The proxies of the pair are kept for the next previews
+			if task is self.previewTask:
+				self.previewSession = task.session
+				show_images(Results, math.ceil(len(Results) / 3.0), Titles, figure="Preview")
+				continue
+			
+			# Results of a replaced task are ignored
+			if task is not self.task:
+				continue
 			
 			self.displayMetrics(arr)
-			show_images(Results, math.ceil(len(Results) / 3.0), Titles)
 			
+			if Results:
+				self.Results += Results
+				self.Titles += Titles
+				show_images(self.Results, math.ceil(len(self.Results) / 3.0), self.Titles, figure="Fusion results")
 			
-			if (self.queue.empty()):
+			if done:
 				self.progressbar.stop()
-			else:
-				self.master.after(2000, self.process_queue)
-			
-		except Empty:
-			self.master.after(2000, self.process_queue)
 			
 	def displayMetrics(self, array):
 		for s in array:
@@ -165,8 +256,9 @@ class Window(Frame):
 
 class ThreadedTask(threading.Thread):
 	
-	def __init__(self, rgb_path, ir_path, queue, strat, wavelet, shortWavelet):
-		threading.Thread.__init__(self)
+	def __init__(self, rgb_path, ir_path, queue, strat, wavelet, shortWavelet, cache = None, notify = None, previous = None,
+				 color = None):
+		threading.Thread.__init__(self, daemon=True)
 		
 		self.rgb_path = rgb_path
 		self.ir_path = ir_path
@@ -174,18 +266,79 @@ class ThreadedTask(threading.Thread):
 		self.strat = strat
 		self.wavelet = wavelet
 		self.shortWavelet = shortWavelet
-		
-		print("Thread started !")
-		
+		self.cache = cache
+		self.notify = notify
+		self.previous = previous
+		self.color = color
+		self.cancelled = threading.Event()
+		
+	def cancel(self):
+		"""
+		Stop the task once the strategy being fused is done
+		"""
+		self.cancelled.set()
+	
+	def post(self, arr, Results = [], Titles = [], done = False):
+		self.queue.put((self, arr, Results, Titles, done))
+		if self.notify is not None:
+			self.notify()
+	
 	def run(self):
-		Res = main(self.rgb_path, self.ir_path, self.strat, self.shortWavelet)
+		# The task replaced by this one stops at the end of its current strategy
+		if self.previous is not None:
+			self.previous.join()
+			self.previous = None
 		
-		Res[0].insert(0, "Metrics for (strategy " + self.strat + ", wavelet " + self.wavelet + ")")
-		Res[0].append("**************************")
+		self.post(["Metrics for (strategy " + self.strat + ", wavelet " + self.wavelet + ")"])
 
-		self.queue.put(Res)
-		
-		print("Thread (strategy : " + self.strat + ", wavelet " + self.wavelet + ") ended ! ")
+		try:
+			main(self.rgb_path, self.ir_path, self.strat, self.shortWavelet, workers=os.cpu_count(), cache=self.cache,
+				 callback=lambda R: self.post(*R), cancel=self.cancelled, color=self.color)
+		except Exception as e:
+			# The error is shown with the metrics, its traceback on the console
+			traceback.print_exc()
+			self.post(["Error : %s: %s" % (type(e).__name__, e)])
+		finally:
+			self.post(["Cancelled" if self.cancelled.is_set() else "**************************"], done=True)
+
+class PreviewTask(ThreadedTask):
+	"""
+	Fusion of the proxies of the pair downscaled for the preview mode, posted to the queue
+	once all the strategies requested are fused. The proxies are made by the first task of
+	a pair, the next ones reusing them.
+	"""
+	
+	def __init__(self, rgb_path, ir_path, queue, strat, wavelet, shortWavelet, session = None, notify = None, previous = None,
+				 color = None):
+		ThreadedTask.__init__(self, rgb_path, ir_path, queue, strat, wavelet, shortWavelet, None, notify, previous, color)
+		self.session = session
+	
+	def run(self):
+		# The preview replaced by this one stops at the end of its current strategy, its
+		# proxies being reused if they are of the same pair
+		if self.previous is not None:
+			self.previous.join()
+			if self.session is None and (self.previous.rgb_path, self.previous.ir_path, self.previous.color) == \
+										(self.rgb_path, self.ir_path, self.color):
+				self.session = self.previous.session
+			self.previous = None
+		
+		if self.session is None:
+			self.session = FusionSession(cv2.imread(self.rgb_path, 1), cv2.imread(self.ir_path, 1 if self.color is None else 0),
+										 color=self.color).preview()
+		
+		strategy = self.strat
+		if strategy == AUTO:
+			strategy = selectStrategy(self.session, self.shortWavelet)[0]
+		strategies = strategyNames() if strategy == "All" else [strategy]
+		
+		Results = []
+		for s in strategies:
+			if self.cancelled.is_set():
+				return
+			Results.append(cv2.cvtColor(self.session.fuse(s, self.shortWavelet), cv2.COLOR_BGR2RGB))
+		
+		self.post([], Results, [s + " (preview)" for s in strategies], done=True)
 
 
 if __name__ == '__main__':
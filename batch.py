@@ -0,0 +1,358 @@
+import argparse
+import csv
+import json
+import os
+import re
+import glob
+import traceback
+from collections import Counter, namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from pywt import families
+from fuse import FusionSession, COLOR_SPACES
+from main import fuseImage, selectStrategy, STRATEGIES, AUTO, METRICS as FUSION_METRICS
+from strategies import strategyNames
+from cache import FusionCache
+from registration import TRANSFORMS, TransformCache, estimateTransform, warp
+from prefetch import readImage, writeImage, prefetch, Writer
+
+# Layout written by ImageRegistration.m : the RGB image and the registered IR image
+# of a same number n
+RGB_PATTERN = 'rgb/IMG_{}.jpg'
+IR_PATTERN = 'cropped/test{}.jpg'
+
+METRICS = list(FUSION_METRICS) + ["Time"]
+FIELDS = ["name", "rgb", "ir", "strategy", "criterion", "wavelet", "output"] + METRICS + ["error"]
+
+# A pair to fuse and how (see fusePair) : matrix is the transform registering the IR image
+# onto the RGB image, or None, color the color space of the luminance fusion, or None,
+# metrics the names of the metrics to compute, extension the format of the fused images
+# and criterion the metric the "Auto" strategy is chosen by
+Job = namedtuple("Job", ["name", "rgb", "ir", "strategies", "wavelet", "output_dir", "dtype", "cache", "matrix", "color",
+						 "metrics", "extension", "criterion"])
+
+def pairsFromDirectory(root, rgb_pattern = RGB_PATTERN, ir_pattern = IR_PATTERN):
+	"""
+	List the RGB/IR pairs of a directory
+	
+	root 		- the directory
+	rgb_pattern - the path of the RGB images relative to root, {} standing for the image number
+	ir_pattern 	- the path of the IR images relative to root, {} standing for the image number
+	
+	
+	Return a list of tuples (name, rgb_path, ir_path), sorted by name. Images without
+	a counterpart are ignored.
+	"""
+	def __index(pattern):
+		before, after = pattern.split('{}')
+		regex = re.compile(re.escape(before) + '(.+)' + re.escape(after) + '$')
+		files = {}
+		for path in glob.glob(os.path.join(root, pattern.replace('{}', '*'))):
+			match = regex.match(os.path.relpath(path, root).replace(os.sep, '/'))
+			if match:
+				files[match.group(1)] = path
+		return files
+	
+	rgb = __index(rgb_pattern)
+	ir = __index(ir_pattern)
+	
+	return [(name, rgb[name], ir[name]) for name in sorted(rgb.keys() & ir.keys())]
+
+def pairsFromManifest(path):
+	"""
+	List the RGB/IR pairs of a manifest
+	
+	path - the manifest, a CSV file with the columns rgb, ir and optionally name (by default
+		   the path of the RGB image relative to the manifest, without extension, its
+		   directories joined by _). Relative paths are relative to the manifest.
+	
+	
+	Return a list of tuples (name, rgb_path, ir_path)
+	"""
+	root = os.path.dirname(os.path.abspath(path))
+	pairs = []
+	
+	with open(path, newline='') as f:
+		for row in csv.DictReader(f):
+			rgb = os.path.join(root, row["rgb"])
+			ir = os.path.join(root, row["ir"])
+			name = row.get("name") or os.path.splitext(os.path.relpath(rgb, root))[0].replace(os.sep, '_').lstrip('._')
+			pairs.append((name, rgb, ir))
+	
+	return pairs
+
+def readPair(job):
+	"""
+	Read the pair of a job (see fusePair) and register the IR image onto the RGB image
+	
+	
+	Return the tuple (I1, I2)
+	"""
+	# Arrays are read at once rather than memory mapped, so that reading them is done
+	# ahead by the prefetching threads too
+	I1 = readImage(job.rgb, 1, mmap=False)
+	I2 = readImage(job.ir, 1 if job.color is None else 0, mmap=False)
+	
+	if job.matrix is not None:
+		I2 = warp(I2, job.matrix, I1.shape)
+	
+	return (I1, I2)
+
+def fusePair(job, images = None, writer = None):
+	"""
+	Fuse one pair with every strategy requested and write the fused images.
+	Runs in the worker processes.
+	
+	job 	- the Job of the pair
+	images 	- the pair read ahead (see readPair), or the exception raised reading it
+			  (default : the pair is read here)
+	writer 	- the prefetch.Writer writing the fused images in the background
+			  (default : they are written here)
+	
+	
+	Return a list of rows (dict), one per strategy, with the metrics of the fused image
+	or the error raised (a single row for all the strategies if the pair cannot be read)
+	"""
+	base = {"name" : job.name, "rgb" : job.rgb, "ir" : job.ir, "wavelet" : job.wavelet}
+	rows = []
+	
+	try:
+		if isinstance(images, Exception):
+			raise images
+		
+		I1, I2 = images or readPair(job)
+		session = FusionSession(I1, I2, dtype=job.dtype, color=job.color)
+	except Exception:
+		return [dict(base, strategy=",".join(job.strategies), error=traceback.format_exc(limit=1).strip())]
+		
+	# The metrics of a fused image are computed by a thread while the image is
+	# written and the next strategy is fused. The errors are caught per strategy, so
+	# that the rows of the strategies fused are kept.
+	with ThreadPoolExecutor(1) as executor:
+		fused = []
+		for strategy in job.strategies:
+			row = dict(base, strategy=strategy)
+			try:
+				if strategy == AUTO:
+					row["strategy"] = strategy = selectStrategy(session, job.wavelet, job.criterion)[0]
+					row["criterion"] = job.criterion
+				
+				result, measures = fuseImage(I1, I2, strategy, job.wavelet, session, job.cache, job.metrics, executor)
+			
+				row["output"] = os.path.join(job.output_dir, job.name + '_' + strategy + '.' + job.extension)
+				if writer is not None:
+					writer.write(row["output"], cv2.cvtColor(result, cv2.COLOR_RGB2BGR))
+				else:
+					writeImage(row["output"], cv2.cvtColor(result, cv2.COLOR_RGB2BGR))
+				fused.append((row, measures))
+			except Exception:
+				fused.append((dict(row, error=traceback.format_exc(limit=1).strip()), None))
+			
+		for row, measures in fused:
+			try:
+				if measures is not None:
+					row.update(measures.values())
+			except Exception:
+				row["error"] = traceback.format_exc(limit=1).strip()
+			rows.append(row)
+	
+	return rows
+
+def fuseChunk(jobs):
+	"""
+	Fuse the pairs of a chunk of jobs (see fusePair). Runs in the worker processes : the
+	next pairs are read and decoded by threads while a pair is fused, and the fused
+	images are encoded and written by other threads.
+	
+	
+	Return the rows of each pair, list of lists of rows
+	"""
+	results = []
+	
+	with Writer() as writer:
+		for job, images, error in prefetch(jobs, readPair):
+			results.append(fusePair(job, images if error is None else error, writer))
+	
+	for rows in results:
+		for row in rows:
+			if row.get("output") in writer.errors:
+				row["error"] = writer.errors[row["output"]]
+	
+	return results
+
+def run(pairs, output_dir, strategy = "All", wavelet = 'db', workers = None, metrics_path = None, dtype = None, cache = None,
+		transforms = None, color = None, metrics = FUSION_METRICS, sample = 1, extension = "png", criterion = "SSIM"):
+	"""
+	Fuse pairs of images over a pool of processes
+	
+	pairs 			- the pairs to fuse, list of tuples (name, rgb_path, ir_path)
+	output_dir 		- the directory the fused images are written to
+	strategy 		- the strategy to apply, "All", or "Auto" for the strategy chosen for
+					  each pair (see main.selectStrategy)
+	wavelet 		- the wavelet to use
+	workers 		- the number of processes (default : the number of CPUs)
+	metrics_path 	- the file the metrics are written to, CSV or JSON depending on its
+					  extension (default : metrics.csv in output_dir)
+	dtype 			- the precision of the fusion and metrics, np.float32 for single
+					  precision (default : double precision)
+	cache 			- the cache.FusionCache shared by the processes (optional)
+	transforms 		- the transforms registering the IR images onto the RGB images, one
+					  per pair (see rigTransforms) (optional)
+	color 			- the color space of the luminance fusion, "ycrcb" or "hsv"
+					  (default : the BGR channels are fused)
+	metrics 		- the names of the metrics to compute (see main.METRICS)
+	sample 			- the metrics are only computed for one pair out of sample, the
+					  other rows only have the fusion time
+	extension 		- the format of the fused images, "npy" for raw arrays (BGR)
+	criterion 		- the metric the strategy is chosen by with "Auto"
+	
+	
+	Return the number of pairs that failed. Raise ValueError if several pairs have the
+	same name.
+	"""
+	# The fused images of a pair are named after it : two pairs of the same name would
+	# overwrite each other
+	duplicates = sorted(name for name, count in Counter(name for name, _, _ in pairs).items() if count > 1)
+	if duplicates:
+		raise ValueError("several pairs are named %s, their fused images would overwrite each other" % ", ".join(duplicates[:10]))
+	
+	strategies = strategyNames() if strategy == "All" else [strategy]
+	metrics_path = metrics_path or os.path.join(output_dir, "metrics.csv")
+	os.makedirs(output_dir, exist_ok=True)
+	
+	transforms = transforms or [None] * len(pairs)
+	jobs = [Job(name, rgb, ir, strategies, wavelet, output_dir, dtype, cache, matrix, color,
+				metrics if n % sample == 0 else (), extension, criterion)
+			for n, ((name, rgb, ir), matrix) in enumerate(zip(pairs, transforms))]
+	workers = workers or os.cpu_count()
+	# Chunks amortize the inter-process communication on large batches, and the reading
+	# of the next pairs of a chunk is overlapped with the fusion
+	chunksize = max(1, min(16, len(jobs) // (4 * workers)))
+	chunks = [jobs[n:n + chunksize] for n in range(0, len(jobs), chunksize)]
+	failed = 0
+	rows = []
+	
+	with ProcessPoolExecutor(max_workers=workers) as executor:
+		for n, result in enumerate(result for chunk in executor.map(fuseChunk, chunks) for result in chunk):
+			errors = [row["error"] for row in result if row.get("error")]
+			if errors:
+				failed += 1
+				print("Failed " + result[0]["name"] + " : " + errors[0])
+			rows += result
+			
+			if (n + 1) % 100 == 0:
+				print("%d / %d pairs fused" % (n + 1, len(jobs)))
+	
+	writeMetrics(rows, metrics_path)
+	print("%d pairs fused, %d failed, metrics written to %s" % (len(jobs) - failed, failed, metrics_path))
+	
+	return failed
+
+def rigTransforms(rigs, transform = "rigid", transforms = None):
+	"""
+	Estimate the transform of each camera rig on its first pair, so that the other
+	pairs of the rig are only warped
+	
+	rigs 		- the pairs of each rig, list of tuples (rig, pairs)
+	transform 	- the kind of transform : "translation", "rigid" or "similarity"
+	transforms 	- the registration.TransformCache of the rigs, the transforms it
+				  already holds are not estimated again (optional)
+	
+	
+	Return the transforms, one per pair, in the order of the pairs of the rigs
+	"""
+	transforms = transforms or TransformCache()
+	matrices = []
+	
+	for rig, pairs in rigs:
+		if not pairs:
+			continue
+		
+		if transforms.get(rig) is None:
+			_, rgb_path, ir_path = pairs[0]
+			print("Registering " + rig + " on " + rgb_path)
+			transforms.put(rig, estimateTransform(readImage(rgb_path, 1), readImage(ir_path, 1), transform))
+		
+		matrices += [transforms.get(rig)] * len(pairs)
+	
+	return matrices
+
+def writeMetrics(rows, path):
+	"""
+	Write the metrics rows to a CSV or JSON file, depending on the extension of path
+	"""
+	if path.lower().endswith('.json'):
+		with open(path, 'w') as f:
+			json.dump(rows, f, indent=1)
+	else:
+		with open(path, 'w', newline='') as f:
+			writer = csv.DictWriter(f, fieldnames=FIELDS)
+			writer.writeheader()
+			writer.writerows(rows)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Fuse RGB/IR pairs in batch, without GUI")
+	parser.add_argument('inputs', nargs='+', help="directories in the layout of ImageRegistration.m, or CSV manifests (rgb, ir, name)")
+	parser.add_argument('-o', '--output', default='fused', help="directory of the fused images")
+	parser.add_argument('-s', '--strategy', default='All', choices=["All", AUTO] + STRATEGIES)
+	parser.add_argument('--criterion', default='SSIM', choices=FUSION_METRICS,
+						help="metric the strategy of each pair is chosen by on a proxy of the pair, with -s Auto")
+	parser.add_argument('-w', '--wavelet', default='db', choices=families()[:7])
+	parser.add_argument('-j', '--workers', type=int, default=None, help="number of processes (default : number of CPUs)")
+	parser.add_argument('-m', '--metrics', default=None, help="metrics file, .csv or .json (default : OUTPUT/metrics.csv)")
+	parser.add_argument('-f', '--float32', action='store_true', help="fuse and compute the metrics in single precision")
+	parser.add_argument('-e', '--extension', default='png', choices=['png', 'jpg', 'tiff', 'bmp', 'npy'],
+						help="format of the fused images, npy for raw arrays")
+	parser.add_argument('--select', nargs='*', default=FUSION_METRICS, choices=FUSION_METRICS, metavar='METRIC',
+						help="metrics to compute, among %s (default : all, none if the option is empty)" % ", ".join(FUSION_METRICS))
+	parser.add_argument('--sample', type=int, default=1, help="compute the metrics of one pair out of SAMPLE only")
+	parser.add_argument('--color', default=None, choices=list(COLOR_SPACES),
+						help="fuse the luminance of the RGB images in this color space with the IR images, keeping the colors")
+	parser.add_argument('-c', '--cache', default=None, help="directory of a cache of the fused images and metrics, shared between runs")
+	parser.add_argument('--cache-size', type=float, default=1., help="size limit of the cache, in GB")
+	parser.add_argument('-r', '--register', default=None, choices=list(TRANSFORMS),
+						help="register the IR images onto the RGB images, with one transform per input (rig)")
+	parser.add_argument('--transforms', default=None, help="JSON file of the transforms of the rigs (default : OUTPUT/transforms.json)")
+	parser.add_argument('--rgb-pattern', default=RGB_PATTERN, help="RGB images in the input directories, {} being the image number")
+	parser.add_argument('--ir-pattern', default=IR_PATTERN, help="IR images in the input directories, {} being the image number")
+	args = parser.parse_args()
+	
+	if args.sample < 1:
+		parser.error("--sample must be at least 1, got %d" % args.sample)
+	
+	rigs = []
+	for path in args.inputs:
+		if os.path.isdir(path):
+			pairs = pairsFromDirectory(path, args.rgb_pattern, args.ir_pattern)
+		else:
+			pairs = pairsFromManifest(path)
+		
+		# The pairs of several inputs are named after their input, as their numbers repeat
+		if len(args.inputs) > 1:
+			rig = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+			pairs = [(rig + '_' + name, rgb, ir) for name, rgb, ir in pairs]
+		rigs.append((path, pairs))
+	
+	pairs = [pair for _, rig in rigs for pair in rig]
+	
+	if not pairs:
+		print("No pair of images found, ending program...")
+		exit()
+	
+	cache = FusionCache(args.cache, int(args.cache_size * 2**30)) if args.cache else None
+	transforms = None
+	
+	if args.register:
+		os.makedirs(args.output, exist_ok=True)
+		transforms = rigTransforms(rigs, args.register,
+								   TransformCache(args.transforms or os.path.join(args.output, "transforms.json")))
+	
+	try:
+		failed = run(pairs, args.output, args.strategy, args.wavelet, args.workers, args.metrics,
+					 np.float32 if args.float32 else None, cache, transforms, args.color, args.select, args.sample, args.extension,
+					 args.criterion)
+	except ValueError as e:
+		parser.error(str(e))
+	exit(1 if failed else 0)
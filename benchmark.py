@@ -0,0 +1,364 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy as np
+import pywt
+from pywt import families
+from fuse import FusionSession, fusedImage
+from temporal import TemporalFusion
+from main import STRATEGIES, fuseMetrics
+from profiling import Profile
+from metrics import *
+
+# (width, height) of the synthetic pairs
+SIZES = {
+	"VGA" 	: (640, 480),
+	"720p" 	: (1280, 720),
+	"1080p" : (1920, 1080),
+	"4K" 	: (3840, 2160),
+	"8K" 	: (7680, 4320),
+}
+
+EXAMPLES = ('examples/rgb.jpg', 'examples/ir.png')
+
+# Only the first wavelets are functionnal (see GUI.Window)
+WAVELETS = families()[:7]
+
+def syntheticPair(width, height, seed = 0):
+	"""
+	Generate a reproducible pair of RGB/IR images : a colored scene with shapes and
+	noise, and a blurred thermal view of the same scene with a few hot spots
+	
+	width 	- the width of the images
+	height 	- the height of the images
+	seed 	- the seed of the random generator
+	
+	
+	Return a tuple (I1, I2) of BGR uint8 images
+	"""
+	rng = np.random.RandomState(seed)
+	
+	y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+	scene = np.dstack([128 + 100 * np.sin(x / (17. + 10 * c) + y / (23. + 5 * c)) for c in range(3)])
+	
+	for _ in range(20):
+		cx, cy = rng.randint(0, width), rng.randint(0, height)
+		r = rng.randint(5, max(6, min(width, height) // 8))
+		cv2.circle(scene, (cx, cy), r, tuple(float(v) for v in rng.randint(0, 256, 3)), -1)
+	
+	I1 = np.clip(scene + rng.normal(0, 8, scene.shape), 0, 255).astype(np.uint8)
+	
+	thermal = cv2.GaussianBlur(scene.mean(axis=2), (0, 0), 3)
+	for _ in range(5):
+		cx, cy = rng.randint(0, width), rng.randint(0, height)
+		cv2.circle(thermal, (cx, cy), rng.randint(3, max(4, min(width, height) // 20)), 255., -1)
+	
+	thermal = np.clip(thermal + rng.normal(0, 4, thermal.shape), 0, 255).astype(np.uint8)
+	I2 = cv2.cvtColor(thermal, cv2.COLOR_GRAY2BGR)
+	
+	return (I1, I2)
+
+def syntheticSequence(width, height, frames = 12, seed = 0):
+	"""
+	Generate a reproducible sequence of RGB/IR frames : the synthetic pair with new sensor
+	noise on each frame, a rectangle moving every other frame, and a rectangle appearing
+	halfway on a flat area, whose edges only change the odd rows and columns of the coarsest
+	detail subbands
+	
+	width 	- the width of the frames
+	height 	- the height of the frames
+	frames 	- the number of frames
+	seed 	- the seed of the random generator
+	
+	
+	Return a list of tuples (I1, I2) of BGR uint8 frames
+	"""
+	rng = np.random.RandomState(seed)
+	I1, I2 = syntheticPair(width, height, seed)
+	I1[48:128, 208:416] = 100
+	I2[48:128, 208:416] = 60
+	sequence = []
+	
+	for n in range(frames):
+		F1, F2 = I1.astype(np.float32), I2.astype(np.float32)
+		
+		x = width // 8 + (n // 2) * width // 40
+		F1[height // 2:height // 2 + height // 8, x:x + width // 8] = 20
+		F2[height // 2:height // 2 + height // 8, x:x + width // 8] = 240
+		
+		# Edges in the middle of the blocks of 16 pixels of the 4th level
+		if n >= frames // 2:
+			F1[56:120, 216:408] = 230
+			F2[56:120, 216:408] = 250
+		
+		F1 += rng.normal(0, 2, F1.shape)
+		F2 += rng.normal(0, 2, F2.shape)
+		sequence.append((np.clip(F1, 0, 255).astype(np.uint8), np.clip(F2, 0, 255).astype(np.uint8)))
+	
+	return sequence
+
+def timeit(function, repeat = 3):
+	"""
+	Return the best time of repeat calls of function, in seconds
+	"""
+	best = float('inf')
+	for _ in range(repeat):
+		time_start = time.perf_counter()
+		function()
+		best = min(best, time.perf_counter() - time_start)
+	return best
+
+def benchmarkPair(name, I1, I2, strategies = STRATEGIES, wavelets = WAVELETS, repeat = 3, verbose = True):
+	"""
+	Time the decomposition and every strategy for every wavelet, and every metric, on a pair
+	
+	name 		- the name of the pair, used in the keys of the results
+	I1 			- the first image
+	I2 			- the second image
+	strategies 	- the strategies to time
+	wavelets 	- the wavelets to time
+	repeat 		- the number of runs, the best one being kept
+	
+	
+	Return a dict {key: seconds} with the keys "decompose/name/wavelet",
+	"fuse/name/wavelet/strategy" and "metric/name/metric"
+	"""
+	results = {}
+	
+	def __record(key, seconds):
+		results[key] = seconds
+		if verbose:
+			print("%-40s %.4fs" % (key, seconds))
+	
+	for wavelet in wavelets:
+		__record("decompose/%s/%s" % (name, wavelet),
+				 timeit(lambda: FusionSession(I1, I2).coefficients(wavelet), repeat))
+		
+		# The decomposition is shared, only the fusion and the recomposition are timed
+		session = FusionSession(I1, I2)
+		session.coefficients(wavelet)
+		
+		for strategy in strategies:
+			__record("fuse/%s/%s/%s" % (name, wavelet, strategy),
+					 timeit(lambda: session.fuse(strategy, wavelet), repeat))
+	
+	result = cv2.cvtColor(FusionSession(I1, I2).fuse("Mean"), cv2.COLOR_BGR2RGB)
+	gray = cv2.cvtColor(result, cv2.COLOR_RGB2GRAY)
+	I1_gray = cv2.cvtColor(I1, cv2.COLOR_RGB2GRAY)
+	I2_gray = cv2.cvtColor(I2, cv2.COLOR_RGB2GRAY)
+	sp_m = spatial(gray)
+	sp_input = spatial_reference(I1_gray, I2_gray)
+	
+	metrics = {
+		"Spatial Frequency" : lambda: spatial(gray),
+		"Spatial Reference" : lambda: spatial_reference(I1_gray, I2_gray),
+		"rSFe" 				: lambda: rSFe(sp_m, sp_input),
+		"SSIM" 				: lambda: SSIM(I1, result),
+		"Entropy" 			: lambda: entr(result),
+		"IQI" 				: lambda: IQI(I1, result),
+	}
+	
+	for metric, function in metrics.items():
+		__record("metric/%s/%s" % (name, metric), timeit(function, repeat))
+	
+	return results
+
+def run(sizes = ("VGA",), examples = True, strategies = STRATEGIES, wavelets = WAVELETS, repeat = 3, seed = 0):
+	"""
+	Run the benchmark suite
+	
+	sizes 		- the sizes of the synthetic pairs (keys of SIZES)
+	examples 	- also benchmark the pair of examples/
+	strategies 	- the strategies to time
+	wavelets 	- the wavelets to time
+	repeat 		- the number of runs of each measure, the best one being kept
+	seed 		- the seed of the synthetic pairs
+	
+	
+	Return a dict {"environment": {...}, "results": {key: seconds}}
+	"""
+	results = {}
+	
+	if examples and all(os.path.exists(path) for path in EXAMPLES):
+		I1, I2 = cv2.imread(EXAMPLES[0], 1), cv2.imread(EXAMPLES[1], 1)
+		results.update(benchmarkPair("examples", I1, I2, strategies, wavelets, repeat))
+	
+	for size in sizes:
+		I1, I2 = syntheticPair(*SIZES[size], seed=seed)
+		results.update(benchmarkPair(size, I1, I2, strategies, wavelets, repeat))
+	
+	environment = {
+		"python" 	: platform.python_version(),
+		"numpy" 	: np.__version__,
+		"pywt" 		: pywt.__version__,
+		"opencv" 	: cv2.__version__,
+		"machine" 	: platform.machine(),
+		"cpus" 		: os.cpu_count(),
+		"repeat" 	: repeat,
+		"seed" 		: seed,
+	}
+	
+	return {"environment" : environment, "results" : results}
+
+def accuracy(I1, I2, strategies = STRATEGIES, wavelets = WAVELETS):
+	"""
+	Compare the single precision path to the double precision one on a pair
+	
+	I1 			- the first image
+	I2 			- the second image
+	strategies 	- the strategies to compare
+	wavelets 	- the wavelets to compare
+	
+	
+	Return a list of dicts, one per wavelet and strategy, with the largest difference
+	of the fused images (in gray levels), the fraction of pixels that differ, the
+	differences of the metrics and the peak memory of the fusion of both paths
+	"""
+	rows = []
+	
+	for wavelet in wavelets:
+		for strategy in strategies:
+			row = {"wavelet" : wavelet, "strategy" : strategy}
+			fused = {}
+			
+			for dtype in (np.float64, np.float32):
+				profile = Profile(memory=True)
+				with profile.stage("fusion"):
+					result, values = fuseMetrics(I1, I2, strategy, wavelet, FusionSession(I1, I2, dtype=dtype))
+				fused[dtype] = (result, values)
+				row["peak_memory_%s" % np.dtype(dtype).name] = profile.records[-1]["peak_memory"]
+			
+			(result64, values64), (result32, values32) = fused[np.float64], fused[np.float32]
+			difference = np.abs(result64.astype(int) - result32.astype(int))
+			row["max_difference"] = int(difference.max())
+			row["differing_pixels"] = float((difference > 0).mean())
+			
+			for metric in ("Spatial Frequency", "rSFe", "SSIM", "Entropy", "IQI"):
+				row[metric] = values32[metric] - values64[metric]
+			
+			rows.append(row)
+	
+	return rows
+
+def temporalAccuracy(sequence, strategies = STRATEGIES, threshold = 0.5, refresh = 30, global_stats = False):
+	"""
+	Compare the fusion of a sequence reusing the weights of the strategies (see
+	temporal.TemporalFusion) to the fusion of each frame
+	
+	sequence 		- the frames, as a list of tuples (I1, I2)
+	strategies 		- the strategies to compare
+	threshold 		- the threshold of the change of the blocks
+	refresh 		- the number of frames between two computations of all the weights
+	global_stats 	- reuse the weights of the strategies using statistics of the whole subband too
+	
+	
+	Return a list of dicts, one per strategy, with the largest mean and maximum differences of
+	the fused frames (in gray levels) and the time of both fusions
+	"""
+	rows = []
+	
+	for strategy in strategies:
+		temporal = TemporalFusion(strategy, threshold=threshold, refresh=refresh, global_stats=global_stats)
+		row = {"strategy" : strategy, "mean_difference" : 0., "max_difference" : 0, "temporal" : 0., "frames" : 0.}
+		
+		for I1, I2 in sequence:
+			start = time.time()
+			reused = temporal.fuse(I1, I2)
+			row["temporal"] += time.time() - start
+			
+			start = time.time()
+			fused = fusedImage(I1, I2, strategy)
+			row["frames"] += time.time() - start
+			
+			difference = np.abs(reused.astype(int) - fused.astype(int))
+			row["mean_difference"] = max(row["mean_difference"], float(difference.mean()))
+			row["max_difference"] = max(row["max_difference"], int(difference.max()))
+		
+		rows.append(row)
+	
+	return rows
+
+def compare(current, baseline, tolerance = 0.2, min_seconds = 0.005):
+	"""
+	Compare the results of a run to a baseline
+	
+	current 	- the results of the run (dict {key: seconds})
+	baseline 	- the results of the baseline (dict {key: seconds})
+	tolerance 	- the relative slowdown allowed
+	min_seconds - the absolute slowdown under which a difference is considered as noise
+	
+	
+	Return a list of tuples (key, baseline seconds, current seconds, ratio) of the regressions
+	"""
+	regressions = []
+	
+	for key in sorted(current.keys() & baseline.keys()):
+		before, after = baseline[key], current[key]
+		if after > before * (1 + tolerance) and after - before > min_seconds:
+			regressions.append((key, before, after, after / before))
+	
+	return regressions
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Benchmark the strategies, wavelets and metrics")
+	parser.add_argument('--sizes', nargs='*', default=["VGA", "720p", "1080p"], choices=list(SIZES),
+						help="sizes of the synthetic pairs")
+	parser.add_argument('--no-examples', action='store_true', help="do not benchmark the pair of examples/")
+	parser.add_argument('-s', '--strategies', nargs='*', default=STRATEGIES, choices=STRATEGIES)
+	parser.add_argument('-w', '--wavelets', nargs='*', default=WAVELETS, choices=WAVELETS)
+	parser.add_argument('-r', '--repeat', type=int, default=3, help="runs of each measure, the best one is kept")
+	parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic pairs")
+	parser.add_argument('--save', default=None, help="save the results to a JSON file (e.g. a new baseline)")
+	parser.add_argument('--compare', default=None, help="baseline JSON file to compare the results to")
+	parser.add_argument('--tolerance', type=float, default=0.2, help="relative slowdown allowed before reporting a regression")
+	parser.add_argument('--accuracy', action='store_true', help="compare the single precision path to the double precision one instead")
+	parser.add_argument('--temporal', type=float, default=None, metavar='THRESHOLD',
+						help="compare the fusion of a synthetic sequence reusing the weights to the fusion of each frame instead")
+	parser.add_argument('--temporal-global', action='store_true',
+						help="with --temporal, reuse the weights of Entropy, Edge and MACD too")
+	args = parser.parse_args()
+	
+	if args.temporal is not None:
+		print("%-10s %-10s %10s %9s %10s %10s" % ("sequence", "strategy", "mean diff", "max diff", "temporal", "frames"))
+		for size in args.sizes:
+			for row in temporalAccuracy(syntheticSequence(*SIZES[size], seed=args.seed), args.strategies, args.temporal,
+										 global_stats=args.temporal_global):
+				print("%-10s %-10s %10.3f %9d %9.2fs %9.2fs" % (size, row["strategy"], row["mean_difference"], row["max_difference"],
+					  row["temporal"], row["frames"]))
+		sys.exit(0)
+	
+	if args.accuracy:
+		pairs = [("examples", cv2.imread(EXAMPLES[0], 1), cv2.imread(EXAMPLES[1], 1))] if not args.no_examples else []
+		pairs += [(size,) + syntheticPair(*SIZES[size], seed=args.seed) for size in args.sizes]
+		
+		print("%-10s %-8s %-10s %8s %9s %10s %10s %10s %10s %10s %7s" % ("pair", "wavelet", "strategy", "max diff", "differing",
+			  "d SF", "d rSFe", "d SSIM", "d Entropy", "d IQI", "memory"))
+		for name, I1, I2 in pairs:
+			for row in accuracy(I1, I2, args.strategies, args.wavelets):
+				print("%-10s %-8s %-10s %8d %8.3f%% %10.2e %10.2e %10.2e %10.2e %10.2e %6.0f%%" % (name, row["wavelet"], row["strategy"],
+					  row["max_difference"], 100 * row["differing_pixels"], row["Spatial Frequency"], row["rSFe"],
+					  row["SSIM"], row["Entropy"], row["IQI"], 100. * row["peak_memory_float32"] / row["peak_memory_float64"]))
+		sys.exit(0)
+	
+	report = run(args.sizes, not args.no_examples, args.strategies, args.wavelets, args.repeat, args.seed)
+	
+	if args.save:
+		with open(args.save, 'w') as f:
+			json.dump(report, f, indent=1, sort_keys=True)
+	
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)
+		
+		regressions = compare(report["results"], baseline["results"], args.tolerance)
+		
+		for key, before, after, ratio in regressions:
+			print("REGRESSION %-40s %.4fs -> %.4fs (x%.2f)" % (key, before, after, ratio))
+		
+		print("%d regressions against %s" % (len(regressions), args.compare))
+		sys.exit(1 if regressions else 0)
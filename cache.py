@@ -0,0 +1,181 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+
+import numpy as np
+import metrics
+from strategies import REGISTRY
+
+# Changing the pipeline in a way that changes the fused images or the metrics should
+# bump this, so that the results of the previous version are not served anymore
+VERSION = 3
+
+# Fraction of max_bytes the cache is reduced to when it grows over it, so that the next
+# entries are stored without scanning the directory again
+EVICT_TARGET = 0.9
+
+# Number of entries stored between two scans of the directory : in between, the size of
+# the cache is the one of the last scan plus the entries stored since, which misses the
+# entries stored by the other processes
+SCAN_INTERVAL = 64
+
+DEFAULT_DIRECTORY = os.environ.get("FUSION_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "thermal-fusion"))
+
+def pairDigest(I1, I2):
+	"""
+	Hash the pixel data of a pair of images
+	
+	I1 - the first image
+	I2 - the second image
+	
+	
+	Return the hexadecimal digest, which only depends on the shapes, types and pixels of the images
+	"""
+	h = hashlib.blake2b(digest_size=20)
+	for I in (I1, I2):
+		I = np.ascontiguousarray(I)
+		h.update(("%s %s;" % (I.shape, I.dtype.str)).encode())
+		h.update(memoryview(I).cast('B'))
+	return h.hexdigest()
+
+class FusionCache:
+	"""
+	Persistent cache of the fused images and their metrics, keyed by the pixels of the
+	pair, the strategy (and the function registered under its name), the wavelet, the
+	decomposition level, the precision, the color space and metrics.ENTROPY_BINS.
+	
+	Each entry is a file of the directory, written to a temporary file then renamed,
+	so that several processes can share the cache : a reader sees a complete entry or
+	none. The least recently used entries are removed when the cache grows over
+	max_bytes, the last use of an entry being the modification time of its file. The
+	directory is only scanned when the entry stored may take the cache over max_bytes,
+	or every SCAN_INTERVAL entries.
+	"""
+	
+	def __init__(self, directory = DEFAULT_DIRECTORY, max_bytes = 2**30):
+		"""
+		directory 	- the directory of the cache (created if needed), $FUSION_CACHE
+					  or ~/.cache/thermal-fusion by default
+		max_bytes 	- the size limit of the cache
+		"""
+		self.directory = directory
+		self.max_bytes = max_bytes
+		os.makedirs(directory, exist_ok=True)
+		
+		# The size of the cache at the last scan plus the entries stored since (None
+		# before the first scan)
+		self._size = None
+		self._stored = 0
+	
+	def key(self, digest, strategy, wavelet, level, dtype = None, color = None):
+		"""
+		Return the key of an entry
+		
+		digest 		- the pairDigest of the pair
+		strategy 	- the fusion strategy
+		wavelet 	- the wavelet
+		level 		- the number of decomposition levels
+		dtype 		- the precision of the fusion (None for double precision)
+		color 		- the color space of the luminance fusion (None for the BGR channels)
+		"""
+		# A strategy registered again under the same name (see strategies.registerStrategy),
+		# or other bins of the entropies, give other fused images
+		function = getattr(REGISTRY.get(strategy), "function", None)
+		identity = "%s.%s" % (function.__module__, function.__qualname__) if function is not None else ""
+		
+		name = "%d|%s|%s|%s|%s|%d|%s|%s|%s" % (VERSION, digest, strategy, identity, wavelet, level, np.dtype(dtype or np.float64).name,
+											  color or "bgr", metrics.ENTROPY_BINS)
+		return hashlib.blake2b(name.encode(), digest_size=20).hexdigest()
+	
+	def _path(self, key):
+		return os.path.join(self.directory, key + ".npz")
+	
+	def get(self, key):
+		"""
+		Return the entry (image, values) stored under key, or None
+		"""
+		path = self._path(key)
+		
+		try:
+			with np.load(path, allow_pickle=False) as data:
+				image = data["image"]
+				values = json.loads(str(data["values"]))
+			# Mark the entry as recently used
+			os.utime(path)
+		except (OSError, KeyError, ValueError):
+			# Missing, removed by another process meanwhile, or unreadable
+			return None
+		
+		return (image, values)
+	
+	def put(self, key, image, values):
+		"""
+		Store an entry, then remove the least recently used ones if the cache is too large
+		
+		key 	- the key of the entry
+		image 	- the fused image
+		values 	- the metrics of the image (dict {name: float})
+		"""
+		buffer = io.BytesIO()
+		np.savez(buffer, image=image, values=np.array(json.dumps(values)))
+		data = buffer.getvalue()
+		
+		fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(data)
+			os.replace(tmp_path, self._path(key))
+		except OSError:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)
+			raise
+		
+		if self._size is None or self._size + len(data) > self.max_bytes or self._stored >= SCAN_INTERVAL:
+			self.evict()
+		else:
+			self._size += len(data)
+			self._stored += 1
+	
+	def evict(self):
+		"""
+		Remove the least recently used entries if the cache is over max_bytes, until it fits
+		in EVICT_TARGET * max_bytes
+		"""
+		entries = []
+		for entry in os.scandir(self.directory):
+			if entry.name.endswith(".npz"):
+				try:
+					stat = entry.stat()
+				except OSError:
+					continue
+				entries.append((stat.st_mtime, stat.st_size, entry.path))
+		
+		total = sum(size for _, size, _ in entries)
+		target = self.max_bytes * EVICT_TARGET if total > self.max_bytes else self.max_bytes
+		
+		for _, size, path in sorted(entries):
+			if total <= target:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				# Already removed by another process
+				pass
+			total -= size
+		
+		self._size, self._stored = total, 0
+	
+	def clear(self):
+		"""
+		Remove every entry of the cache
+		"""
+		for entry in os.scandir(self.directory):
+			if entry.name.endswith(".npz"):
+				try:
+					os.remove(entry.path)
+				except OSError:
+					pass
+
+		self._size, self._stored = 0, 0
@@ -1,8 +1,28 @@
 import numpy as np
+import cv2
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pywt import wavedec2, waverec2, wavelist
-from fusionStrategies import MACD, edgeDetection, deviation, coeffsEntropy
+from strategies import getStrategy
+from fusionStrategies import Workspace
+from metrics import spatial_reference, LocalStatistics
+from cache import pairDigest
+from profiling import NO_PROFILE
 
-def fusedImage(I1, I2, FUSION_METHOD, wavelet = 'db'):
+LEVEL = 4
+
+# Largest side of the proxies fused by the preview mode, in pixels (the size of the
+# canvases of the GUI)
+PREVIEW_SIZE = 384
+
+# Color spaces of the luminance fusion : the conversions from and to BGR, and the
+# channel of the luminance
+COLOR_SPACES = {
+	"ycrcb" 	: (cv2.COLOR_BGR2YCrCb, cv2.COLOR_YCrCb2BGR, 0),
+	"hsv" 		: (cv2.COLOR_BGR2HSV, cv2.COLOR_HSV2BGR, 2),
+}
+
+def fusedImage(I1, I2, FUSION_METHOD, wavelet = 'db', dtype = None, workers = None, color = None):
 	"""
 	Fusion algorithm using wavelets
 	
@@ -10,36 +30,324 @@ def fusedImage(I1, I2, FUSION_METHOD, wavelet = 'db'):
 	I2				- the second image
 	FUSION_METOD	- the fusion strategy to apply to the coefficients
 	wavelet 		- the wavelet to use
+	dtype 			- the precision of the computations, np.float32 for single
+					  precision (default : double precision)
+	workers 		- the number of threads fusing the subbands concurrently
+					  (default : one after another)
+	color 			- the color space of the luminance fusion, "ycrcb" or "hsv"
+					  (default : the BGR channels are fused)
 	
 	
 	Return fused image 
 	"""
+	return FusionSession(I1, I2, dtype=dtype, workers=workers, color=color).fuse(FUSION_METHOD, wavelet)
+
+def fusedSources(images, FUSION_METHOD, wavelet = 'db', dtype = None, workers = None, color = None, level = LEVEL, profile = None):
+	"""
+	Fusion of N registered sources (e.g. visible, LWIR and NIR) in a single pass : the
+	sources are decomposed at once, stacked along a new first axis, each subband of all
+	the sources is fused by the strategy, and the result is recomposed and normalized once,
+	instead of chaining the fusions of pairs (with a recomposition and a normalization to
+	8 bits after each one)
+	
+	images 			- the sources, the visible image first (the same size)
+	FUSION_METHOD	- the fusion strategy to apply to the coefficients
+	wavelet 		- the wavelet to use
+	dtype 			- the precision of the computations, np.float32 for single
+					  precision (default : double precision)
+	workers 		- the number of threads fusing the subbands concurrently
+					  (default : one after another)
+	color 			- the color space of the luminance fusion, "ycrcb" or "hsv"
+					  (default : the BGR channels are fused)
+	level 			- the number of decomposition levels
+	profile 		- the Profile timing the stages of the fusion (optional)
+	
+	
+	Return fused image 
+	"""
+	profile = profile or NO_PROFILE
+	
+	with profile.stage("sources", sources=len(images), color=color):
+		converted, planes = sourcePlanes(images, color)
+	with profile.stage("wavedec2", input="sources", wavelet=wavelet, sources=len(planes)):
+		coeffs = decomposeSources(planes, wavelet, level, dtype)
+	fusedCoeff = fuseSources(coeffs, FUSION_METHOD, profile, workers)
+	
+	with profile.stage("waverec2", strategy=FUSION_METHOD, wavelet=wavelet):
+		fusedImage = reconstruct(fusedCoeff, wavelet, images[0].shape[:2])
+	with profile.stage("normalize", strategy=FUSION_METHOD, wavelet=wavelet):
+		fusedImage = normalize(fusedImage)
+	
+	if color is None:
+		return fusedImage
+	with profile.stage("color", strategy=FUSION_METHOD, wavelet=wavelet, color=color):
+		return colorize(converted, fusedImage, color)
+
+def luminance(I1, I2, color = "ycrcb"):
+	"""
+	Convert the visible image to a color space, and the IR image to a single channel
+	
+	I1 		- the visible image (BGR)
+	I2 		- the IR image (single channel, or BGR)
+	color 	- the color space, "ycrcb" or "hsv"
+	
+	
+	Return a tuple (converted, plane1, plane2) : the converted visible image, its
+	luminance plane and the IR plane
+	"""
+	if color not in COLOR_SPACES:
+		raise ValueError("unknown color space %r, expected one of %s" % (color, ", ".join(COLOR_SPACES)))
+	
+	to_space, _, channel = COLOR_SPACES[color]
+	converted = cv2.cvtColor(I1, to_space)
+	
+	if I2.ndim == 3:
+		I2 = cv2.cvtColor(I2, cv2.COLOR_BGR2GRAY)
+	
+	return (converted, converted[:, :, channel], I2)
+
+def colorize(converted, plane, color = "ycrcb"):
+	"""
+	Put a fused luminance plane in place of the luminance of the visible image, which
+	keeps its chroma
+	
+	converted 	- the visible image, converted by luminance()
+	plane 		- the fused luminance plane (uint8), cropped to the size of the image
+	color 		- the color space, "ycrcb" or "hsv"
+	
+	
+	Return fused image (BGR)
+	"""
+	_, from_space, channel = COLOR_SPACES[color]
+	
+	result = converted.copy()
+	result[:, :, channel] = plane[:result.shape[0], :result.shape[1]]
+	return cv2.cvtColor(result, from_space)
+
+def sourcePlanes(images, color = None):
+	"""
+	Prepare N sources to be fused together : without a color space, the single channel
+	sources are converted to BGR if any source is BGR, and with a color space the visible
+	image is converted to it and the other sources to a single channel (see luminance())
+	
+	images 	- the sources, the visible image first
+	color 	- the color space, "ycrcb" or "hsv" (optional)
+	
+	
+	Return a tuple (converted, planes) : the converted visible image (None without a color
+	space) and the list of the planes to fuse
+	"""
+	if len(images) < 2:
+		raise ValueError("at least two sources are needed, got %d" % len(images))
+	
+	if color is None:
+		converted = None
+		bgr = any(I.ndim == 3 for I in images)
+		planes = [cv2.cvtColor(I, cv2.COLOR_GRAY2BGR) if bgr and I.ndim == 2 else I for I in images]
+	else:
+		converted, plane1, plane2 = luminance(images[0], images[1], color)
+		planes = [plane1, plane2] + [cv2.cvtColor(I, cv2.COLOR_BGR2GRAY) if I.ndim == 3 else I for I in images[2:]]
+	
+	if any(plane.shape != planes[0].shape for plane in planes):
+		raise ValueError("the sources must be registered to the same size, got " + ", ".join(str(plane.shape) for plane in planes))
+	
+	return (converted, planes)
+
+def downscale(I, max_size = PREVIEW_SIZE):
+	"""
+	Downscale an image so that its largest side is at most max_size
+	
+	I 			- the image
+	max_size 	- the largest side of the result, in pixels
+	
+	
+	Return the downscaled image (I itself if it is already small enough)
+	"""
+	scale = float(max_size) / max(I.shape[:2])
+	if scale >= 1:
+		return I
+	
+	size = (max(1, int(round(I.shape[1] * scale))), max(1, int(round(I.shape[0] * scale))))
+	return cv2.resize(I, size, interpolation=cv2.INTER_AREA)
+
+def decompose(I, wavelet = 'db', level = LEVEL, dtype = None):
+	"""
+	Apply the wavelet decomposition to an image
+	
+	I 		- the image
+	wavelet - the wavelet family to use
+	level 	- the number of decomposition levels
+	dtype 	- the precision of the coefficients, np.float32 for single precision
+			  (default : double precision)
+	
+	
+	Return the coefficients (cA, (cH_n, cV_n, cD_n), ...., ..(cH_1, cV_1, cD_1))
+	"""
+	wave = wavelist(wavelet)[0]
+	
+	# wavedec2 keeps float32 inputs in float32, any other input is computed in float64
+	if dtype is not None:
+		I = np.asarray(I, dtype=dtype)
+	
+	return wavedec2(I, wave, level=level, axes=(0, 1))
+	
+def decomposeSources(planes, wavelet = 'db', level = LEVEL, dtype = None):
+	"""
+	Apply the wavelet decomposition to N images at once, stacked along a new first axis
+	
+	planes 	- the images (the same shape)
+	wavelet - the wavelet family to use
+	level 	- the number of decomposition levels
+	dtype 	- the precision of the coefficients, np.float32 for single precision
+			  (default : double precision)
+	
+	
+	Return the coefficients (cA, (cH_n, cV_n, cD_n), ...., ..(cH_1, cV_1, cD_1)), each one
+	an array (N, ...) of the subbands of the images
+	"""
 	wave = wavelist(wavelet)[0]
 	
-	# Apply wavelets on both image
-	coeff1 = wavedec2(I1, wave, level=4, axes=(0, 1))
-	coeff2 = wavedec2(I2, wave, level=4, axes=(0, 1))
+	stack = np.stack(planes)
+	if dtype is not None:
+		stack = stack.astype(dtype, copy=False)
+	
+	return wavedec2(stack, wave, level=level, axes=(1, 2))
+
+def fuseCoefficients(coeff1, coeff2, FUSION_METHOD, profile = NO_PROFILE, workers = None, overwrite = False):
+	"""
+	Apply the fusion strategy to every level of two decompositions
+	
+	coeff1 			- the decomposition of the first image
+	coeff2 			- the decomposition of the second image
+	FUSION_METHOD 	- the fusion strategy to apply to the coefficients
+	profile 		- the Profile timing the fusion of each subband (optional)
+	workers 		- the number of threads fusing the subbands concurrently
+					  (default : the subbands are fused one after another)
+	overwrite 		- the coefficients of coeff1 are not needed anymore, in place
+					  strategies may write the result to them
 	
+	
+	Return fused decomposition
+	"""
+	strategy = getStrategy(FUSION_METHOD)
+	# The temporary arrays of the strategy are reused from one subband to the next, in a
+	# Workspace per thread freed with the fusion
+	workspaces = threading.local()
+	
+	def __fuse(level, subband, c1, c2):
+		if not hasattr(workspaces, 'workspace'):
+			workspaces.workspace = Workspace()
+		with profile.stage("fusion", strategy=FUSION_METHOD, level=level, subband=subband):
+			return strategy(c1, c2, out=c1 if overwrite else None, workspace=workspaces.workspace)
+	
+	# Elementwise strategies are a single pass over memory per subband, dispatching
+	# them to threads costs more than it saves
+	return fuseSubbands(__fuse, [coeff1, coeff2], None if strategy.elementwise else workers)
+
+def fuseSources(coeffs, FUSION_METHOD, profile = NO_PROFILE, workers = None):
+	"""
+	Apply the fusion strategy to every level of the stacked decomposition of N sources
+	(see Strategy.fuseSources)
+	
+	coeffs 			- the decomposition of the sources, computed by decomposeSources
+	FUSION_METHOD 	- the fusion strategy to apply to the coefficients
+	profile 		- the Profile timing the fusion of each subband (optional)
+	workers 		- the number of threads fusing the subbands concurrently
+					  (default : the subbands are fused one after another)
+	
+	
+	Return fused decomposition
+	"""
+	strategy = getStrategy(FUSION_METHOD)
+	
+	def __fuse(level, subband, c):
+		with profile.stage("fusion", strategy=FUSION_METHOD, level=level, subband=subband, sources=len(c)):
+			return strategy.fuseSources(c)
+	
+	return fuseSubbands(__fuse, [coeffs], None if strategy.elementwise else workers)
+
+def fuseSubbands(function, decompositions, workers = None):
+	"""
+	Fuse every subband of the decompositions given
+	
+	function 		- the function fusing a subband, called as function(level, name, c1, c2, ...)
+					  with the subband of each decomposition
+	decompositions 	- the decompositions
+	workers 		- the number of threads fusing the subbands concurrently
+					  (default : the subbands are fused one after another)
+	
+	
+	Return fused decomposition
+	"""
+	coeff1 = decompositions[0]
+	
+	# coeffs = (cA, (cH_n, cV_n, cD_n), ...., ..(cH_1, cV_1, cD_1))
 	# For each level of decomposition, apply the fusion scheme wanted
-	fusedCoeff = []
-	for i in range(len(coeff1)):
-		# coeffs = (cA, (cH_n, cV_n, cD_n), ...., ..(cH_1, cV_1, cD_1))
+	subbands = [(len(coeff1) - 1, "cA") + tuple(coeffs[0] for coeffs in decompositions)]
+	for i in range(1, len(coeff1)):
+		# For the rest of the levels we have tupels with 3 coefficents
+		level = len(coeff1) - i
+		subbands += [(level, name) + tuple(coeffs[i][k] for coeffs in decompositions) for k, name in enumerate(("cH", "cV", "cD"))]
 		
-		if (i == 0):
-			cA = fuseCoeff(coeff1[0], coeff2[0], FUSION_METHOD)
-			fusedCoeff.append(cA)
-
-		else:
-			# For the rest of the levels we have tupels with 3 coefficents
-			cH = fuseCoeff(coeff1[i][0], coeff2[i][0], FUSION_METHOD)
-			cV = fuseCoeff(coeff1[i][1], coeff2[i][1], FUSION_METHOD)
-			cD = fuseCoeff(coeff1[i][2], coeff2[i][2], FUSION_METHOD)
-			fusedCoeff.append((cH, cV, cD))
+	if workers and workers > 1:
+		# The subbands are independent and the strategies mostly release the GIL.
+		# The largest subbands are submitted first, and the results are gathered
+		# in order, so the result does not depend on the scheduling.
+		with ThreadPoolExecutor(workers) as executor:
+			futures = [executor.submit(function, *subband) for subband in reversed(subbands)]
+			fused = [future.result() for future in reversed(futures)]
+	else:
+		fused = [function(*subband) for subband in subbands]
+
+	return [fused[0]] + [tuple(fused[k:k + 3]) for k in range(1, len(fused), 3)]
+
+def recompose(fusedCoeff, wavelet = 'db', shape = None):
+	"""
+	Recompose and normalize an image from its fused decomposition
+	
+	fusedCoeff 	- the fused decomposition
+	wavelet 	- the wavelet family to use
+	shape 		- the size (rows, columns) of the decomposed images (optional, see reconstruct)
+	
+	
+	Return fused image (uint8)
+	"""
+	return normalize(reconstruct(fusedCoeff, wavelet, shape))
+
+def reconstruct(fusedCoeff, wavelet = 'db', shape = None):
+	"""
+	Recompose an image from its fused decomposition, without normalization
+	
+	fusedCoeff 	- the fused decomposition
+	wavelet 	- the wavelet family to use
+	shape 		- the size (rows, columns) of the decomposed images : the row and column
+				  waverec2 adds to odd sizes are cropped, so that they do not take part
+				  in the normalization (optional)
+	
+	
+	Return fused image (float)
+	"""
+	wave = wavelist(wavelet)[0]
 			
 	# Recompose the result image
 	fusedImage = waverec2(fusedCoeff, wave, axes=(0, 1))
-	# Normalize the values
-	fusedImage = np.multiply(np.divide(fusedImage - np.min(fusedImage),(np.max(fusedImage) - np.min(fusedImage))),255)
+	return fusedImage if shape is None else fusedImage[:shape[0], :shape[1]]
+
+def normalize(fusedImage, low = None, high = None):
+	"""
+	Normalize the values of a recomposed image to [0, 255]
+	
+	fusedImage 	- the recomposed image
+	low 		- the value mapped to 0 (default : the minimum of the image)
+	high 		- the value mapped to 255 (default : the maximum of the image)
+	
+	
+	Return normalized image (uint8)
+	"""
+	low = np.min(fusedImage) if low is None else low
+	high = np.max(fusedImage) if high is None else high
+	
+	fusedImage = np.multiply(np.divide(fusedImage - low,(high - low)),255)
 	fusedImage = fusedImage.astype(np.uint8)
 	
 	return fusedImage
@@ -50,22 +358,160 @@ def fuseCoeff(coeff1, coeff2, method):
 	
 	coeff1 - coefficient of the RGB image
 	coeff2 - coefficient of the IR image
-	method - the fusion strategy to apply
+	method - the fusion strategy to apply (see strategies.registerStrategy)
 	
 	
 	Return fused coefficient 
 	"""
-	if (method == 'Mean'):
-		return (coeff1 + coeff2)/2
-	elif (method == 'Min'):
-		return np.minimum(coeff1, coeff2)
-	elif (method == 'Max'):
-		return np.maximum(coeff1, coeff2)
-	elif (method == "Entropy"):
-		return coeffsEntropy(coeff1, coeff2)
-	elif method == 'MACD':
-		return MACD(coeff1, coeff2)
-	elif method == 'Edge':
-		return edgeDetection(coeff1, coeff2)
-	elif (method == "Deviation"):
-		return deviation(coeff1, coeff2)
+	return getStrategy(method)(coeff1, coeff2)
+
+class FusionSession:
+	"""
+	Fusion of one pair of images with any number of strategies and wavelets.
+	
+	Each input is decomposed only once per wavelet, and the reference data of
+	the pair used by the metrics is only computed once, so running several
+	strategies on the same pair only pays for the fusion and the recomposition.
+	
+	With a color space, only the luminance of the visible image and the IR image
+	(a single channel) are decomposed and fused, a third of the work of fusing the
+	three BGR channels, and the chroma of the visible image is put back.
+	"""
+	
+	def __init__(self, I1, I2, level = LEVEL, profile = None, dtype = None, workers = None, color = None):
+		"""
+		I1 		- the first image (RGB)
+		I2 		- the second image (IR), which may be single channel with a color space
+		level 	- the number of decomposition levels
+		profile - the Profile timing the stages of the fusion (optional)
+		dtype 	- the precision of the computations, np.float32 for single
+				  precision (default : double precision)
+		workers - the number of threads fusing the subbands concurrently
+				  (default : one after another)
+		color 	- the color space of the luminance fusion, "ycrcb" or "hsv"
+				  (default : the BGR channels are fused)
+		"""
+		if color is not None and color not in COLOR_SPACES:
+			raise ValueError("unknown color space %r, expected one of %s" % (color, ", ".join(COLOR_SPACES)))
+		
+		self.I1 = I1
+		self.I2 = I2
+		self.level = level
+		self.profile = profile or NO_PROFILE
+		self.dtype = dtype
+		self.workers = workers
+		self.color = color
+		
+		self._planes = None
+		self._coeffs = {}
+		self._reference = None
+		self._statistics = None
+		self._digest = None
+		self._previews = {}
+	
+	def coefficients(self, wavelet = 'db'):
+		"""
+		Return the decompositions (coeff1, coeff2) of both images for the wavelet given,
+		computing them on the first call only
+		"""
+		if wavelet not in self._coeffs:
+			_, I1, I2 = self.planes()
+			with self.profile.stage("wavedec2", input="I1", wavelet=wavelet):
+				coeff1 = decompose(I1, wavelet, self.level, self.dtype)
+			with self.profile.stage("wavedec2", input="I2", wavelet=wavelet):
+				coeff2 = decompose(I2, wavelet, self.level, self.dtype)
+			self._coeffs[wavelet] = (coeff1, coeff2)
+		return self._coeffs[wavelet]
+	
+	def planes(self):
+		"""
+		Return the images fused, as a tuple (converted, plane1, plane2) : with a color space
+		the visible image converted to it, its luminance and the IR plane (see luminance()),
+		else (None, I1, I2). The conversion is only computed on the first call.
+		"""
+		if self.color is None:
+			return (None, self.I1, self.I2)
+		
+		if self._planes is None:
+			with self.profile.stage("color", color=self.color):
+				self._planes = luminance(self.I1, self.I2, self.color)
+		return self._planes
+	
+	def fuse(self, FUSION_METHOD, wavelet = 'db'):
+		"""
+		Fuse the pair with the strategy and wavelet given
+		
+		FUSION_METHOD	- the fusion strategy to apply to the coefficients
+		wavelet 		- the wavelet to use
+		
+		
+		Return fused image
+		"""
+		coeff1, coeff2 = self.coefficients(wavelet)
+		fusedCoeff = fuseCoefficients(coeff1, coeff2, FUSION_METHOD, self.profile, self.workers)
+		
+		with self.profile.stage("waverec2", strategy=FUSION_METHOD, wavelet=wavelet):
+			fusedImage = reconstruct(fusedCoeff, wavelet, self.I1.shape[:2])
+		with self.profile.stage("normalize", strategy=FUSION_METHOD, wavelet=wavelet):
+			fusedImage = normalize(fusedImage)
+		
+		if self.color is None:
+			return fusedImage
+		with self.profile.stage("color", strategy=FUSION_METHOD, wavelet=wavelet, color=self.color):
+			return colorize(self.planes()[0], fusedImage, self.color)
+	
+	def fuseAll(self, strategies, wavelet = 'db'):
+		"""
+		Fuse the pair with every strategy given, sharing the decompositions
+		
+		strategies 	- the fusion strategies to apply
+		wavelet 	- the wavelet to use
+		
+		
+		Return a dict {strategy: fused image}
+		"""
+		return {strategy: self.fuse(strategy, wavelet) for strategy in strategies}
+	
+	def reference(self):
+		"""
+		Return the reference data of the pair used by the metrics, as a tuple
+		(I1_gray, I2_gray, sp_input), computing it on the first call only
+		"""
+		if self._reference is None:
+			with self.profile.stage("reference"):
+				I1_gray = cv2.cvtColor(self.I1, cv2.COLOR_RGB2GRAY)
+				I2_gray = cv2.cvtColor(self.I2, cv2.COLOR_RGB2GRAY) if self.I2.ndim == 3 else self.I2
+				self._reference = (I1_gray, I2_gray, spatial_reference(I1_gray, I2_gray))
+		return self._reference
+
+	def statistics(self):
+		"""
+		Return the metrics.LocalStatistics of the first image, shared by the IQI and SSIM of
+		the images fused with every strategy, computing it on the first call only
+		"""
+		if self._statistics is None:
+			with self.profile.stage("statistics"):
+				self._statistics = LocalStatistics(self.I1)
+		return self._statistics
+	
+	def preview(self, max_size = PREVIEW_SIZE):
+		"""
+		Return the FusionSession of the pair downscaled to max_size, to fuse a preview
+		of any strategy and wavelet in a few milliseconds, computing it on the first
+		call only
+		"""
+		if max_size not in self._previews:
+			with self.profile.stage("downscale", size=max_size):
+				I1, I2 = downscale(self.I1, max_size), downscale(self.I2, max_size)
+			self._previews[max_size] = FusionSession(I1, I2, self.level, self.profile, self.dtype, color=self.color)
+		return self._previews[max_size]
+	
+	def digest(self):
+		"""
+		Return the hash of the pixels of the pair (see cache.pairDigest), computing it
+		on the first call only
+		"""
+		if self._digest is None:
+			with self.profile.stage("digest"):
+				self._digest = pairDigest(self.I1, self.I2)
+		return self._digest
@@ -1,72 +1,196 @@
 import numpy as np
+from collections import OrderedDict
 from skimage import filters
 from skimage.color.adapt_rgb import adapt_rgb, each_channel
-from skimage.measure.entropy import shannon_entropy
+from metrics import entr
 from scipy import ndimage
 
 @adapt_rgb(each_channel)
 def sobel_each(image):
 	return filters.sobel(image)
 
-def MACD(coeff1, coeff2):
+class Workspace:
+	"""
+	Buffers reused by the strategies from one subband to the next, instead of allocating
+	full-size temporaries for every subband. The buffers of the last max_shapes shapes
+	(and dtypes) are kept, until the workspace is dropped : fuse.fuseCoefficients creates
+	one per thread for the fusion of a decomposition.
+	"""
+	
+	def __init__(self, max_shapes = 8):
+		self.max_shapes = max_shapes
+		self._buffers = OrderedDict()
+	
+	def get(self, name, shape, dtype):
+		"""
+		Return the buffer called name of the shape and dtype given (uninitialized)
+		"""
+		key = (tuple(shape), np.dtype(dtype))
+		buffers = self._buffers.pop(key, {})
+		self._buffers[key] = buffers
+		
+		while len(self._buffers) > self.max_shapes:
+			self._buffers.popitem(last=False)
+		
+		if name not in buffers:
+			buffers[name] = np.empty(shape, dtype)
+		return buffers[name]
+
+def MACD(coeff1, coeff2, window = 5, fract = 0.5, workspace = None):
 	"""
 	Apply the MACD fusion strategy to the coefficients given in parameters
 	
-	coeff1 - coefficient of the RGB image
-	coeff2 - coefficient of the IR image
+	coeff1 		- coefficient of the RGB image
+	coeff2 		- coefficient of the IR image
+	window 		- the size of the match window
+	fract 		- threshold between pure maximum and weighted max
+	workspace 	- the Workspace of the temporary arrays (default : a new one)
 	
 	
 	Return fused coefficient 
 	"""
-	A1 = Activity(coeff1)
-	A2 = Activity(coeff2)
-	M = Match(coeff1, coeff2)
-	D = Decision(A1, A2, M)	
-	return np.where(D == 0., np.maximum(coeff1, coeff2), D * coeff1 + (1 - D) * coeff2)
+	workspace = workspace or Workspace()
+	D = MACDWeights(coeff1, coeff2, window, fract, workspace)
+	return MACDCombine(coeff1, coeff2, D, workspace)
+
+def MACDWeights(coeff1, coeff2, window = 5, fract = 0.5, workspace = None):
+	"""
+	Compute the decision map of the MACD fusion strategy (Activity, Match and Decision steps)
+	
+	coeff1 		- coefficient of the RGB image
+	coeff2 		- coefficient of the IR image
+	window 		- the size of the match window
+	fract 		- threshold between pure maximum and weighted max
+	workspace 	- the Workspace of the temporary arrays (default : a new one)
+	
+	
+	Return decision coefficient
+	"""
+	workspace = workspace or Workspace()
+	shape, dtype = coeff1.shape, np.result_type(coeff1, coeff2)
 	
-def Activity(coeff):
+	A1 = Activity(coeff1, workspace.get("A1", shape, dtype))
+	A2 = Activity(coeff2, workspace.get("A2", shape, dtype))
+	M = Match(coeff1, coeff2, window, workspace)
+	return Decision(A1, A2, M, fract, workspace)
+
+def MACDCombine(coeff1, coeff2, D, workspace = None):
+	"""
+	Fuse the coefficients given in parameters with a decision map of the MACD fusion strategy
+	
+	coeff1 		- coefficient of the RGB image
+	coeff2 		- coefficient of the IR image
+	D 			- the decision map, computed by MACDWeights
+	workspace 	- the Workspace of the temporary arrays (default : a new one)
+	
+	
+	Return fused coefficient 
+	"""
+	workspace = workspace or Workspace()
+	shape, dtype = coeff1.shape, np.result_type(coeff1, coeff2)
+	
+	# np.where(D == 0., np.maximum(coeff1, coeff2), D * coeff1 + (1 - D) * coeff2)
+	tmp = workspace.get("tmp", shape, dtype)
+	mask = workspace.get("mask", shape, bool)
+	
+	result = np.multiply(D, coeff1)
+	result += np.multiply(np.subtract(1, D, out=tmp), coeff2, out=tmp)
+	np.copyto(result, np.maximum(coeff1, coeff2, out=tmp), where=np.equal(D, 0., out=mask))
+	
+	return result
+
+def Activity(coeff, out = None):
 	"""
 	Apply the Activity block of the MACD fusion strategy to the coefficient given in parameter
 	
 	coeff 	- coefficient
+	out 	- the array to write the result to (optional)
 	
 	
 	Return Activity coefficient
 	"""
-	return np.absolute(coeff)
+	return np.absolute(coeff, out=out)
 
-def Match(coeff1, coeff2):
+def Match(coeff1, coeff2, window = 5, workspace = None):
 	"""
 	Apply the Match step of the MACD fusion strategy to the coefficients given in parameters
 	
-	coeff1 - coefficient of the RGB image
-	coeff2 - coefficient of the IR image
+	coeff1 		- coefficient of the RGB image
+	coeff2 		- coefficient of the IR image
+	window 		- the size of the match window
+	workspace 	- the Workspace of the temporary arrays (optional)
 	
 	
-	Return match coefficient
+	Return match coefficient (a buffer of the workspace)
 	"""
-	mult = (coeff1 * coeff2) / (np.abs(coeff1)**2 + np.abs(coeff2)**2 + np.finfo(np.float32).eps)
-	if mult.ndim == 3:
-		kernel = np.ones((5, 5, 3))
-	else:
-		kernel = np.ones((5, 5))
-	return ndimage.convolve(mult, kernel, mode='constant')
+	workspace = workspace or Workspace()
+	shape, dtype = coeff1.shape, np.result_type(coeff1, coeff2)
+	tmp = workspace.get("tmp", shape, dtype)
+	mult = workspace.get("tmp2", shape, dtype)
+
+	# mult = (coeff1 * coeff2) / (|coeff1|^2 + |coeff2|^2 + eps)
+	denominator = np.multiply(coeff1, coeff1, out=tmp)
+	denominator += np.multiply(coeff2, coeff2, out=mult)
+	denominator += np.finfo(np.float32).eps
+	np.multiply(coeff1, coeff2, out=mult)
+	mult /= denominator
+	
+	return boxSum(mult, window, workspace.get("match", shape, dtype), tmp)
 
-def Decision(coeff1, coeff2, m, fract = 0.5):
+def boxSum(x, window = 5, out = None, tmp = None):
+	"""
+	Sum the values of each window x window neighborhood (window x window x 3 for color
+	coefficients, the channels being summed too), zero padded. This is the convolution
+	by np.ones((window, window, 3)), but computed with one pass per axis.
+	
+	x 		- the array
+	window 	- the size of the neighborhood
+	out 	- the array to write the result to (optional)
+	tmp 	- a temporary array of the same shape as x (optional)
+	
+	
+	Return the sums
+	"""
+	out = np.empty_like(x) if out is None else out
+	tmp = np.empty_like(x) if tmp is None else tmp
+	sizes = [window, window] + ([3] if x.ndim == 3 else [])
+	
+	# The passes alternate between both buffers, so that the last one writes to out
+	source, destination = x, (out if len(sizes) % 2 else tmp)
+	for axis, size in enumerate(sizes):
+		ndimage.correlate1d(source, np.ones(size, dtype=x.dtype), axis=axis, output=destination, mode='constant')
+		source, destination = destination, (tmp if destination is out else out)
+	
+	return out
+
+def Decision(coeff1, coeff2, m, fract = 0.5, workspace = None):
 	"""
 	Apply the Decision step of the MACD fusion strategy to the coefficients given in parameters
 	
-	coeff1 - activity array of the RGB image
-	coeff2 - activity array of the IR image
-	m 	   - match array 
-	fract  - threshold between pure maximum and weighted max
+	coeff1 		- activity array of the RGB image
+	coeff2 		- activity array of the IR image
+	m 	   		- match array 
+	fract  		- threshold between pure maximum and weighted max
+	workspace 	- the Workspace of the temporary arrays (optional)
 	
 	
-	Return decision coefficient 
+	Return decision coefficient (a new array)
 	"""
+	workspace = workspace or Workspace()
+	shape, dtype = coeff1.shape, np.result_type(coeff1, coeff2)
+	mask = workspace.get("mask", shape, bool)
+	
 	mean = np.mean(m)
-	delta = coeff1 + coeff2
-	return np.where((delta == 0) | (m > fract * mean), 0.5, coeff1 / (delta + np.finfo(np.float32).eps))
+	delta = np.add(coeff1, coeff2, out=workspace.get("tmp", shape, dtype))
+	
+	# np.where((delta == 0) | (m > fract * mean), 0.5, coeff1 / (delta + eps))
+	decision = np.add(delta, np.finfo(np.float32).eps)
+	np.divide(coeff1, decision, out=decision)
+	np.equal(delta, 0, out=mask)
+	mask |= np.greater(m, fract * mean, out=workspace.get("mask2", shape, bool))
+	np.copyto(decision, 0.5, where=mask)
+	
+	return decision
 	
 def coeffsEntropy(coeff1, coeff2):
 	"""
@@ -78,10 +202,38 @@ def coeffsEntropy(coeff1, coeff2):
 	
 	Return fused coefficient 
 	"""
-	entropy1 = shannon_entropy(coeff1 - coeff1.min())
-	entropy2 = shannon_entropy(coeff2 - coeff2.min())
+	return weightedMean(coeff1, coeff2, entropyWeights(coeff1, coeff2))
+
+def entropyWeights(coeff1, coeff2, bins = None):
+	"""
+	Compute the weights of the entropy fusion strategy
+	
+	coeff1 	- coefficient of the RGB image
+	coeff2 	- coefficient of the IR image
+	bins 	- the number of bins of the histograms of the entropies (see metrics.entr)
+	
+	
+	Return the weights (weight1, weight2, sum of the weights) for weightedMean
+	"""
+	# Entropies in the precision of the coefficients, so that float32 stays float32
+	entropy1 = coeff1.dtype.type(entr(coeff1, bins))
+	entropy2 = coeff2.dtype.type(entr(coeff2, bins))
 	delt = entropy1 + entropy2
-	return (entropy1 * coeff1 + entropy2 * coeff2) / delt
+	return (entropy1, entropy2, delt)
+
+def weightedMean(coeff1, coeff2, weights):
+	"""
+	Average two coefficients with the weights given in parameter
+	
+	coeff1 	- first coefficient
+	coeff2 	- second coefficient
+	weights - the weights (weight1, weight2, sum of the weights)
+	
+	
+	Return fused coefficient
+	"""
+	weight1, weight2, total = weights
+	return (weight1 * coeff1 + weight2 * coeff2) / total
 	
 def edgeDetection(coeff1, coeff2):
 	"""
@@ -94,15 +246,29 @@ def edgeDetection(coeff1, coeff2):
 	
 	Return fused coefficient
 	"""
+	return weightedMean(coeff1, coeff2, edgeWeights(coeff1, coeff2))
+
+def edgeWeights(coeff1, coeff2, bins = None):
+	"""
+	Compute the weights of the edge fusion strategy : the entropies of the Sobel
+	filtered coefficients
+	
+	coeff1 	- first coefficient
+	coeff2 	- second coefficient
+	bins 	- the number of bins of the histograms of the entropies (see metrics.entr)
+	
+	
+	Return the weights (weight1, weight2, sum of the weights) for weightedMean
+	"""
 	edges_RGB = sobel_each(coeff1)
 	edges_IR = sobel_each(coeff2)
 	
-	entropy_RGB = shannon_entropy(edges_RGB - edges_RGB.min())
-	entropy_IR = shannon_entropy(edges_IR - edges_IR.min())
+	entropy_RGB = coeff1.dtype.type(entr(edges_RGB, bins))
+	entropy_IR = coeff2.dtype.type(entr(edges_IR, bins))
 	
 	entropy_sum = entropy_RGB + entropy_IR + np.finfo(np.float32).eps
 	
-	return (entropy_RGB * coeff1 + entropy_IR * coeff2) / entropy_sum
+	return (entropy_RGB, entropy_IR, entropy_sum)
 	
 # def deviation(coeff1, coeff2, window_size = 8):
 	# """
@@ -125,22 +291,292 @@ def deviation(coeff1, coeff2, window_size = 4):
 	Fuse two coefficients by first dividing the coefficients, then using the 
 	standard deviation criterion
 	
-	coeff1 	- first coefficient
-	coeff2 	- second coefficient
+	coeff1 		- first coefficient
+	coeff2 		- second coefficient
+	window_size - the size of the windows the coefficients are divided into
 	
 	
 	Return fused coefficient
 	"""
 	w, h = coeff1.shape[:2]
-	result = np.zeros(coeff1.shape)
 	
-	for i in range(0, w, window_size):
-		for j in range(0, h, window_size):
-			RGB = coeff1[i:min(i + window_size, w), j:min(j + window_size, h)]
-			IR = coeff2[i:min(i + window_size, w), j:min(j + window_size, h)]
+	RGB = padWindows(coeff1, window_size)
+	IR = padWindows(coeff2, window_size)
+
+	weights = (windowsStd(RGB, w, h, window_size), windowsStd(IR, w, h, window_size))
+	
+	return combineWindows(RGB, IR, weights, w, h, window_size)
+
+def deviationWeights(coeff1, coeff2, window_size = 4):
+	"""
+	Compute the weights of the deviation fusion strategy : the standard deviation of
+	every window of both coefficients
+	
+	coeff1 		- first coefficient
+	coeff2 		- second coefficient
+	window_size - the size of the windows the coefficients are divided into
+	
+	
+	Return the weights (stdr, stdi) for deviationCombine
+	"""
+	w, h = coeff1.shape[:2]
+	return (windowsStd(padWindows(coeff1, window_size), w, h, window_size),
+			windowsStd(padWindows(coeff2, window_size), w, h, window_size))
+
+def deviationCombine(coeff1, coeff2, weights, window_size = 4):
+	"""
+	Fuse two coefficients with the standard deviations of their windows
+	
+	coeff1 		- first coefficient
+	coeff2 		- second coefficient
+	weights 	- the weights (stdr, stdi), computed by deviationWeights
+	window_size - the size of the windows the coefficients are divided into
+	
+	
+	Return fused coefficient
+	"""
+	w, h = coeff1.shape[:2]
+	return combineWindows(padWindows(coeff1, window_size), padWindows(coeff2, window_size), weights, w, h, window_size)
+
+def combineWindows(RGB, IR, weights, w, h, window_size = 4):
+	"""
+	Compute (stdr * RGB + stdi * IR) / (stdr + stdi + eps) window by window, in place in
+	the padded coefficients RGB and IR
+	
+	RGB 		- the first coefficient, padded by padWindows()
+	IR 			- the second coefficient, padded by padWindows()
+	weights 	- the standard deviations of the windows (stdr, stdi), left unchanged
+	w 			- the number of rows of the coefficients before padding
+	h 			- the number of columns of the coefficients before padding
+	window_size - the size of the windows
+	
+	
+	Return fused coefficient
+	"""
+	stdr = expandWindows(weights[0], window_size)
+	stdi = expandWindows(weights[1], window_size)
+	
+	result = RGB.reshape(stdr.shape[0], window_size, -1)
+	result *= stdr
+	result += np.multiply(IR.reshape(stdi.shape[0], window_size, -1), stdi, out=IR.reshape(stdi.shape[0], window_size, -1))
+	stdr += stdi
+	stdr += np.finfo(np.float32).eps
+	result /= stdr
+
+	return RGB[:w, :h]
+
+def padWindows(coeff, window_size = 4):
+	"""
+	Pad a coefficient with zeros so that it divides into complete window_size x window_size windows
+	
+	coeff 		- coefficient
+	window_size - the size of the windows
+	
+	
+	Return padded coefficient
+	"""
+	w, h = coeff.shape[:2]
+	padded = np.zeros((-(-w // window_size) * window_size, -(-h // window_size) * window_size) + coeff.shape[2:],
+					  dtype=np.result_type(coeff.dtype, np.float32))
+	padded[:w, :h] = coeff
+	return padded
+
+def expandWindows(x, window_size = 4):
+	"""
+	Expand a value per window along the window columns, so that it broadcasts against a
+	padded coefficient of shape (rows * window_size, ...) reshaped to (rows, window_size, -1)
+	
+	x 			- the values of each window, as an array (rows, columns, ...)
+	window_size - the size of the windows
+	
+	
+	Return the expanded values, as an array (rows, 1, columns * window_size * channels)
+	"""
+	return np.repeat(x, window_size, axis=1).reshape(x.shape[0], 1, -1)
+
+def windowsStd(padded, w, h, window_size = 4):
+	"""
+	Compute the standard deviation of every window (and channel) of a padded coefficient at
+	once. The padding of the windows on the bottom and right edges is ignored.
+	
+	padded 		- the coefficient, padded by padWindows()
+	w 			- the number of rows of the coefficient before padding
+	h 			- the number of columns of the coefficient before padding
+	window_size - the size of the windows
+	
+	
+	Return the standard deviations, as an array (rows, columns, ...)
+	"""
+	rows = padded.shape[0] // window_size
+	cols = padded.shape[1] // window_size
+	
+	def __sum(x):
+		# Summing the window_size slices one by one is much faster than a sum over
+		# the short and strided window axes
+		x = x.reshape((rows, window_size, cols, window_size) + padded.shape[2:])
+		x = sum(x[:, i] for i in range(window_size))
+		return sum(x[:, :, i] for i in range(window_size))
+	
+	rows_size = np.minimum(w - np.arange(rows) * window_size, window_size)
+	cols_size = np.minimum(h - np.arange(cols) * window_size, window_size)
+	count = np.outer(rows_size, cols_size).reshape((rows, cols) + (1,) * (padded.ndim - 2)).astype(padded.dtype)
+	
+	# Two passes, as np.std does : mean of each window, then mean of the squared deviations
+	mean = __sum(padded) / count
+	centered = padded.reshape(rows, window_size, -1) - expandWindows(mean, window_size)
+	centered = centered.reshape(padded.shape)
+	centered[w:] = 0
+	centered[:, h:] = 0
+	
+	return np.sqrt(__sum(np.square(centered, out=centered)) / count)
 
-			stdr = np.std(RGB, axis=(0, 1))
-			stdi = np.std(IR, axis=(0, 1))
-			result[i:min(i+window_size, w), j:min(j+window_size, h)] = (stdr * RGB + stdi * IR) / (stdr + stdi + np.finfo(np.float32).eps)
+# Fusion of N sources at once : the coefficients of the sources are stacked along a new
+# first axis, coeffs[i] being the subband of the source i (the visible image first). With
+# two sources, each function gives the result of the pairwise one up to the rounding.
+
+def MACDSources(coeffs, window = 5, fract = 0.5):
+	"""
+	Apply the MACD fusion strategy to the stacked coefficients of N sources
+	
+	coeffs 	- the coefficients, as an array (N, ...)
+	window 	- the size of the match window
+	fract 	- threshold between pure maximum and weighted max
+	
+	
+	Return fused coefficient
+	"""
+	activity = np.absolute(coeffs)
+	return MACDCombineSources(coeffs, DecisionSources(activity, MatchSources(coeffs, window), fract))
+
+def MatchSources(coeffs, window = 5):
+	"""
+	Apply the Match step of the MACD fusion strategy to the stacked coefficients of N sources :
+	the sum of the products of every two sources over (N - 1) times the sum of the squares,
+	which is the match of the pairwise strategy for two sources
+	
+	coeffs 	- the coefficients, as an array (N, ...)
+	window 	- the size of the match window
+	
+	
+	Return match coefficient
+	"""
+	count = len(coeffs)
+	
+	denominator = np.einsum('i...,i...->...', coeffs, coeffs)
+	denominator *= count - 1
+	denominator += np.finfo(np.float32).eps
+	
+	mult = np.zeros_like(denominator)
+	for i in range(count):
+		for j in range(i + 1, count):
+			mult += coeffs[i] * coeffs[j]
+	mult /= denominator
+	
+	return boxSum(mult, window)
+
+def DecisionSources(activity, m, fract = 0.5):
+	"""
+	Apply the Decision step of the MACD fusion strategy to the activities of N sources :
+	the weight of each source is its share of the activity, or 1 / N where the sources
+	match (or none is active)
+	
+	activity 	- the activities, as an array (N, ...)
+	m 			- match array
+	fract 		- threshold between pure maximum and weighted max
+	
 	
+	Return the weights, as an array (N, ...)
+	"""
+	delta = np.sum(activity, axis=0)
+	mask = np.equal(delta, 0) | np.greater(m, fract * np.mean(m))
+	
+	decision = activity / (delta + np.finfo(np.float32).eps)
+	np.copyto(decision, 1. / len(activity), where=mask)
+	
+	return decision
+
+def MACDCombineSources(coeffs, D):
+	"""
+	Fuse the stacked coefficients of N sources with the weights of the MACD fusion strategy.
+	As with two sources, the maximum is taken where the weight of the first source is 0.
+	
+	coeffs 	- the coefficients, as an array (N, ...)
+	D 		- the weights, computed by DecisionSources
+	
+	
+	Return fused coefficient
+	"""
+	result = np.einsum('i...,i...->...', D, coeffs)
+	np.copyto(result, np.max(coeffs, axis=0), where=np.equal(D[0], 0.))
+	return result
+
+def entropySources(coeffs, bins = None):
+	"""
+	Apply the entropy fusion strategy to the stacked coefficients of N sources
+	
+	coeffs 	- the coefficients, as an array (N, ...)
+	bins 	- the number of bins of the histograms of the entropies (see metrics.entr)
+	
+	
+	Return fused coefficient
+	"""
+	weights = [coeffs.dtype.type(entr(coeff, bins)) for coeff in coeffs]
+	return weightedMeanSources(coeffs, weights, sum(weights))
+
+def edgeSources(coeffs, bins = None):
+	"""
+	Apply the edge fusion strategy to the stacked coefficients of N sources : their mean
+	weighted by the entropies of the Sobel filtered coefficients
+	
+	coeffs 	- the coefficients, as an array (N, ...)
+	bins 	- the number of bins of the histograms of the entropies (see metrics.entr)
+	
+	
+	Return fused coefficient
+	"""
+	weights = [coeffs.dtype.type(entr(sobel_each(coeff), bins)) for coeff in coeffs]
+	return weightedMeanSources(coeffs, weights, sum(weights) + np.finfo(np.float32).eps)
+
+def weightedMeanSources(coeffs, weights, total):
+	"""
+	Average the stacked coefficients of N sources with the weights given in parameter
+	
+	coeffs 	- the coefficients, as an array (N, ...)
+	weights - the weight of each source
+	total 	- the sum of the weights
+	
+	
+	Return fused coefficient
+	"""
+	result = weights[0] * coeffs[0]
+	for weight, coeff in zip(weights[1:], coeffs[1:]):
+		result += weight * coeff
+	result /= total
 	return result
+
+def deviationSources(coeffs, window_size = 4):
+	"""
+	Fuse the stacked coefficients of N sources with the standard deviation criterion : the
+	mean of the sources weighted, window by window, by their standard deviations
+	
+	coeffs 		- the coefficients, as an array (N, ...)
+	window_size - the size of the windows the coefficients are divided into
+	
+	
+	Return fused coefficient
+	"""
+	w, h = coeffs.shape[1:3]
+	
+	padded = [padWindows(coeff, window_size) for coeff in coeffs]
+	stds = [expandWindows(windowsStd(coeff, w, h, window_size), window_size) for coeff in padded]
+	
+	rows = stds[0].shape[0]
+	result = padded[0].reshape(rows, window_size, -1)
+	result *= stds[0]
+	total = stds[0] + np.finfo(np.float32).eps
+	for coeff, std in zip(padded[1:], stds[1:]):
+		result += coeff.reshape(rows, window_size, -1) * std
+		total += std
+	result /= total
+	
+	return padded[0][:w, :h]
@@ -1,26 +1,48 @@
 import cv2
 import numpy as np
 from matplotlib import pyplot as plt
-from fuse import fusedImage
+from fuse import FusionSession, PREVIEW_SIZE
+from strategies import strategyNames
+from profiling import NO_PROFILE
+from prefetch import readImage
 from metrics import *
 import time
 import math
+import threading
+from collections import namedtuple
 from tkinter import filedialog
 import tkinter as tk
 import os
 
-def show_images(images, lines = 1, titles = None, blocking = False):
+# The strategies registered when main is imported, strategyNames() also lists the
+# plugins registered later
+STRATEGIES = strategyNames()
+
+# The metrics of the fused images, in the order they are displayed
+METRICS = ("Spatial Frequency", "rSFe", "SSIM", "Entropy", "IQI")
+
+# The strategy chosen automatically for each pair (see selectStrategy)
+AUTO = "Auto"
+
+# A metric of a fused image : its strategy, the name and value of the metric, and the
+# seconds it took to compute (0 when read from the cache)
+Metric = namedtuple("Metric", ["strategy", "name", "value", "seconds"])
+
+def show_images(images, lines = 1, titles = None, blocking = False, figure = None):
 	"""
 	Displays a figure of images with titles
 	
 	images 	- the images to display
 	lines 	- the number of lines the figure should have
 	titles 	- the titles of each images
+	figure 	- the number or name of the figure to draw in, replacing its content
+			  (default : a new figure)
 	"""
 	
 	n_images = len(images)
 	
-	fig = plt.figure()
+	fig = plt.figure(figure)
+	fig.clf()
 	
 	for n, (image, title) in enumerate(zip(images, titles)):
 		a = fig.add_subplot(lines, np.ceil(n_images/float(lines)), n + 1)
@@ -31,14 +53,34 @@ def show_images(images, lines = 1, titles = None, blocking = False):
 	fig.tight_layout()
 	plt.show(block=blocking)
 
-def main(rgb_path, ir_path, strategy = "All", wavelet='db'):
+def main(rgb_path, ir_path, strategy = "All", wavelet='db', profile = None, dtype = None, workers = None, cache = None,
+		 callback = None, cancel = None, registration = None, color = None, metrics = METRICS, criterion = "SSIM"):
 	"""
 	Main Fusion procedure, applies the fusion algorithm on the image
 	
-	rgb_path  - the path to the RGB image
-	ir_path	  - the path to the infrared image
+	rgb_path  - the path to the RGB image, an image file or a .npy array
+	ir_path	  - the path to the infrared image, an image file or a .npy array
 	strategy  - the fuison strategy to apply to the image
 	wavelet   - the wavelet to use
+	profile   - the profiling.Profile recording the timings of each stage (optional)
+	dtype 	  - the precision of the fusion and metrics, np.float32 for single
+				precision (default : double precision)
+	workers   - the number of threads fusing the subbands of an image concurrently
+				(default : one after another)
+	cache 	  - the cache.FusionCache of the fused images and metrics (optional)
+	callback  - a function called with the tuple (array, Results, Titles) of each
+				strategy as soon as it is fused (optional)
+	cancel 	  - a threading.Event : once set, no other strategy is started, and the
+				results of the strategies already fused are returned (optional)
+	registration - a function registering the IR image onto the RGB image before the
+				fusion, called as registration(I1, I2), e.g.
+				functools.partial(registration.register, key=rig, cache=transforms) (optional)
+	color 	  - the color space of the luminance fusion, "ycrcb" or "hsv" : the infrared
+				image is loaded as a single channel and fused with the luminance of the
+				RGB image, which keeps its colors (default : the BGR channels are fused)
+	metrics   - the names of the metrics to compute (see METRICS)
+	criterion - the metric the strategy is chosen by with the "Auto" strategy
+				(see selectStrategy)
 	-----------
 	
 	Returns a tuple (array, Results, Titles). 
@@ -47,33 +89,85 @@ def main(rgb_path, ir_path, strategy = "All", wavelet='db'):
 	Results - The fused image(s) (array)
 	Titles 	- The name of the image(s) for the display (array)
 	"""
-	I1 = cv2.imread(rgb_path, 1)
-	I2 = cv2.imread(ir_path, 1)
+	profile = profile or NO_PROFILE
+	
+	with profile.stage("load", input="I1"):
+		I1 = readImage(rgb_path, 1)
+	with profile.stage("load", input="I2"):
+		# The infrared image is a single channel, loaded as three channels for the
+		# fusion of the BGR channels only
+		I2 = readImage(ir_path, 1 if color is None else 0)
+	
+	if registration is not None:
+		with profile.stage("registration"):
+			I2 = registration(I1, I2)
+	
+	session = FusionSession(I1, I2, profile=profile, dtype=dtype, workers=workers, color=color)
 	
 	if (strategy == "All"):
-		R_min = fuseSelection(I1, I2, "Min", wavelet)
-		R_max = fuseSelection(I1, I2, "Max", wavelet)
-		R_mean = fuseSelection(I1, I2, "Mean", wavelet)
-		R_entropy = fuseSelection(I1, I2, "Entropy", wavelet)
-		R_MACD = fuseSelection(I1, I2, "MACD", wavelet)
-		R_Edge = fuseSelection(I1, I2, "Edge", wavelet)
-		R_Deviation = fuseSelection(I1, I2, "Deviation", wavelet)
-		
-		array = R_min[0] + ["------"] + R_max[0] + ["------"] + R_mean[0] + ["------"] + R_entropy[0] \
-						 + ["------"] + R_MACD[0] + ["------"] + R_Edge[0] + ["------"] + R_Deviation[0]
-						 
-		Results = R_min[1] + R_max[1] + R_mean[1] + R_entropy[1] \
-				  + R_MACD[1] + R_Edge[1] + R_Deviation[1]
-		
+		array, Results, Titles = [], [], []
 		
-		Titles = R_min[2] + R_max[2] + R_mean[2] + R_entropy[2] \
-				 + R_MACD[2] + R_Edge[2] + R_Deviation[2]
+		for s in strategyNames():
+			if cancel is not None and cancel.is_set():
+				break
+			
+			R = fuseSelection(I1, I2, s, wavelet, session, cache, metrics)
+			if callback is not None:
+				callback(R)
+			
+			if array:
+				array.append("------")
+			array += R[0]
+			Results += R[1]
+			Titles += R[2]
 		
 		return (array, Results, Titles)
+	elif cancel is not None and cancel.is_set():
+		return ([], [], [])
 	else:
-		return fuseSelection(I1, I2, strategy, wavelet)
+		if strategy == AUTO:
+			chosen, _ = selectStrategy(session, wavelet, criterion)
+			array, Results, _ = fuseSelection(I1, I2, chosen, wavelet, session, cache, metrics)
+			R = (["Strategy chosen by " + criterion + " : " + chosen] + array, Results, [AUTO + " : " + chosen])
+		else:
+			R = fuseSelection(I1, I2, strategy, wavelet, session, cache, metrics)
+		
+		if callback is not None:
+			callback(R)
+		return R
+
+def selectStrategy(session, wavelet = 'db', criterion = "SSIM", candidates = None, size = PREVIEW_SIZE):
+	"""
+	Choose the strategy of a pair : the candidates are fused on a proxy of the pair
+	downscaled to size, and scored by a single metric, which costs a fraction of the
+	fusion of one strategy at full resolution
+	
+	session 	- the FusionSession of the pair
+	wavelet 	- the wavelet to use
+	criterion 	- the metric the candidates are scored by (see METRICS) : the best
+				  strategy has the highest value, or the one closest to 0 for rSFe
+	candidates 	- the strategies to choose from (default : every strategy)
+	size 		- the largest side of the proxy
+	
+	
+	Return a tuple (strategy, scores), scores being the criterion of each candidate on
+	the proxy (dict {strategy: float})
+	"""
+	if criterion not in METRICS:
+		raise ValueError("unknown criterion %r, expected one of %s" % (criterion, ", ".join(METRICS)))
+	
+	proxy = session.preview(size)
+	scores = {}
+	
+	for strategy in candidates or strategyNames():
+		_, measures = fuseImage(proxy.I1, proxy.I2, strategy, wavelet, proxy, metrics=(criterion,))
+		scores[strategy] = measures.values()[criterion]
+	
+	best = max(scores, key=lambda strategy: -abs(scores[strategy]) if criterion == "rSFe" else scores[strategy])
+	
+	return (best, scores)
 	
-def fuseSelection(I1, I2, strategy, wavelet):
+def fuseSelection(I1, I2, strategy, wavelet, session = None, cache = None, metrics = METRICS):
 	"""
 	Fuse the images with the fusion strategy given as parameters 
 	
@@ -81,6 +175,10 @@ def fuseSelection(I1, I2, strategy, wavelet):
 	I2 			- the second image
 	strategy	- the strategy to apply
 	wavelet 	- the wavelet to use
+	session 	- the FusionSession of the pair, sharing the decompositions and
+				  reference data between calls (optional)
+	cache 		- the cache.FusionCache of the fused images and metrics (optional)
+	metrics 	- the names of the metrics to compute (see METRICS)
 	-------------
 	
 	Returns a tuple (array, Results, Titles)
@@ -89,11 +187,101 @@ def fuseSelection(I1, I2, strategy, wavelet):
 	Results - The fused image (array)
 	Titles 	- The name of the image for the display (array)
 	"""	
+	result, values = fuseMetrics(I1, I2, strategy, wavelet, session, cache, metrics)
+	
+	array = describe(strategy, values)
+	Results = [result]
+	Titles = [strategy]
+	
+	return (array, Results, Titles)
+
+def describe(strategy, values):
+	"""
+	Format the metrics of a fused image for the display
+
+	strategy 	- the strategy of the fused image
+	values 		- the metrics of the fused image (dict {name: float}, see fuseMetrics)
+	
+	
+	Return the lines of text (array)
+	"""
 	array = []
 	
+	if "Spatial Frequency" in values and "rSFe" in values:
+		array.append("Spatial Frequency of " + strategy + " : " + "%.3f" % values["Spatial Frequency"] + ", rsFe : " + "%.3f" % values["rSFe"])
+	else:
+		array += [name + " of " + strategy + " : " + "%.3f" % values[name] for name in ("Spatial Frequency", "rSFe") if name in values]
+	
+	array += [name + " of " + strategy + " : " + "%.3f" % values[name] for name in ("SSIM", "Entropy", "IQI") if name in values]
+	array.append("Time elapsed for " + strategy + " : " + "%.2f" % values["Time"] + "s")
+	
+	return array
+
+def fuseMetrics(I1, I2, strategy, wavelet, session = None, cache = None, metrics = METRICS):
+	"""
+	Fuse the images with the fusion strategy given as parameters and compute
+	the metrics of the result
+	
+	I1 			- the first image
+	I2 			- the second image
+	strategy	- the strategy to apply
+	wavelet 	- the wavelet to use
+	session 	- the FusionSession of the pair, sharing the decompositions and
+				  reference data between calls (optional)
+	cache 		- the cache.FusionCache of the fused images and metrics : results of
+				  the same pair, strategy, wavelet, level, precision and color space are read
+				  from it instead of being computed again (optional)
+	metrics 	- the names of the metrics to compute (see METRICS)
+	-------------
+	
+	Returns a tuple (result, values)
+	
+	result 	- The fused image (RGB)
+	values 	- The metrics of the fused image (dict {name: float}), with the
+			  fusion time in seconds under "Time"
+	"""
+	result, measures = fuseImage(I1, I2, strategy, wavelet, session, cache, metrics)
+	
+	return (result, measures.values())
+
+def fuseImage(I1, I2, strategy, wavelet, session = None, cache = None, metrics = METRICS, executor = None):
+	"""
+	Fuse the images with the fusion strategy given as parameters. The fused image is
+	returned at once, its metrics being computed apart (see FusionMetrics).
+	
+	I1 			- the first image
+	I2 			- the second image
+	strategy	- the strategy to apply
+	wavelet 	- the wavelet to use
+	session 	- the FusionSession of the pair, sharing the decompositions and
+				  reference data between calls (optional)
+	cache 		- the cache.FusionCache of the fused images and metrics (optional)
+	metrics 	- the names of the metrics to compute (see METRICS), () for none
+	executor 	- the concurrent.futures.Executor computing the metrics in the background
+				  (default : they are computed when they are first read)
+	-------------
+	
+	Returns a tuple (result, metrics)
+	
+	result 	- The fused image (RGB)
+	metrics - The FusionMetrics of the fused image
+	"""
+	if session is None:
+		session = FusionSession(I1, I2)
+	
+	key = None
+	if cache is not None:
+		key = cache.key(session.digest(), strategy, wavelet, session.level, session.dtype, session.color)
+		entry = cache.get(key)
+		if entry is not None:
+			result, values = entry
+			gray = cv2.cvtColor(result, cv2.COLOR_RGB2GRAY)
+			return (result, FusionMetrics(session, strategy, result, gray, values["Time"], metrics, executor, values, cache, key))
+	
 	time_start = time.time()
 	
-	fusion_result = fusedImage(I1, I2, strategy, wavelet)
+	# The recomposition of odd sizes has one more row or column
+	fusion_result = session.fuse(strategy, wavelet)[:session.I1.shape[0], :session.I1.shape[1]]
 	if fusion_result.ndim == 3:
 		result = cv2.cvtColor(fusion_result, cv2.COLOR_BGR2RGB)
 		gray = cv2.cvtColor(result, cv2.COLOR_RGB2GRAY)
@@ -102,32 +290,147 @@ def fuseSelection(I1, I2, strategy, wavelet):
 		gray = fusion_result
 		result = cv2.cvtColor(gray, cv2.COLOR_GRAY2RGB)
 		
-	timing = "%.2f" % (time.time() - time_start)
+	timing = time.time() - time_start
+	
+	return (result, FusionMetrics(session, strategy, result, gray, timing, metrics, executor, None, cache, key))
+
+def computeMetrics(session, strategy, result, gray, names = METRICS):
+	"""
+	Compute metrics of a fused image
+	
+	session 	- the FusionSession of the pair
+	strategy 	- the strategy of the fused image
+	result 		- the fused image (RGB)
+	gray 		- the fused image in gray levels
+	names 		- the names of the metrics to compute, in the order of METRICS
 	
-	I1_gray = cv2.cvtColor(I1, cv2.COLOR_RGB2GRAY)
-	I2_gray = cv2.cvtColor(I2, cv2.COLOR_RGB2GRAY)
 	
-	sp_input = spatial_reference(I1_gray, I2_gray)
-	sp_m = spatial(gray)
+	Return the metrics (list of Metric)
+	"""
+	stage = session.profile.stage
+	records = []
+	sp_m = None
+	
+	# The reference data and the local moments of I1 are computed once per pair, those
+	# of the result once for SSIM and IQI
+	if "rSFe" in names:
+		sp_input = session.reference()[2]
+	if "SSIM" in names or "IQI" in names:
+		statistics = session.statistics()
 	
+	for name in names:
+		time_start = time.perf_counter()
 
-	Entropy_m = "%.3f" % shannon_entropy(result)
-	IQI_m = "%.3f" % IQI(I1, result)
-	Spatial_m = "%.3f" % sp_m.sum()
-	rSFe_m = "%.3f" % rSFe(sp_m, sp_input).sum()
-	SSIM_m = "%.3f" % SSIM(I1, result)
+		with stage("metric", strategy=strategy, metric=name):
+			# rSFe is computed from the spatial frequencies of the fused image
+			if name in ("Spatial Frequency", "rSFe") and sp_m is None:
+				sp_m = spatial(gray)
+			
+			if name == "Spatial Frequency":
+				value = sp_m.sum()
+			elif name == "rSFe":
+				value = rSFe(sp_m, sp_input).sum()
+			elif name == "SSIM":
+				value = SSIM(session.I1, result, session.dtype, statistics)
+			elif name == "Entropy":
+				value = entr(result)
+			else:
+				value = IQI(session.I1, result, session.dtype or 'double', statistics)
 		
-	array.append("Spatial Frequency of " + strategy + " : " + Spatial_m + ", rsFe : " + rSFe_m)
-	array.append("SSIM of " + strategy + " : " + SSIM_m)
-	array.append("Entropy of " + strategy + " : " + Entropy_m)
-	array.append("IQI of " + strategy + " : " + IQI_m)
-	array.append("Time elapsed for " + strategy + " : " + timing+ "s")
+		records.append(Metric(strategy, name, float(value), time.perf_counter() - time_start))
+	
+	# The integral images of the result are five times its size in double precision
+	if "SSIM" in names or "IQI" in names:
+		statistics.release(result)
+	
+	return records
 
-	Results = [result]
-	Titles = [strategy]
+class FusionMetrics:
+	"""
+	The metrics of a fused image, computed apart from its fusion : in the background by
+	an executor while the image is used, or on the first read without executor.
 	
-	return (array, Results, Titles)
+	The metrics read from the cache are not computed again, and the image is written to
+	the cache with all its metrics once they are computed.
+	"""
+	
+	def __init__(self, session, strategy, result, gray, timing, names = METRICS, executor = None,
+				 values = None, cache = None, key = None):
+		"""
+		session 	- the FusionSession of the pair
+		strategy 	- the strategy of the fused image
+		result 		- the fused image (RGB)
+		gray 		- the fused image in gray levels
+		timing 		- the time the fusion took, in seconds
+		names 		- the names of the metrics to compute (see METRICS)
+		executor 	- the concurrent.futures.Executor computing the metrics (optional)
+		values 		- the metrics of the cache entry of the image (dict {name: float}),
+					  None if it was not in the cache
+		cache 		- the cache.FusionCache the image and its metrics are written to (optional)
+		key 		- the key of the image in the cache
+		"""
+		unknown = [name for name in names if name not in METRICS]
+		if unknown:
+			raise ValueError("unknown metrics %s, expected some of %s" % (", ".join(unknown), ", ".join(METRICS)))
+		
+		self.strategy = strategy
+		self.names = tuple(name for name in METRICS if name in names)
+		self.time = timing
+		
+		self._stored = values
+		self._arguments = (session, result, gray)
+		self._cache = (cache, key)
+		self._records = None
+		self._lock = threading.Lock()
+		self._future = executor.submit(self._compute) if executor is not None else None
+	
+	def _compute(self):
+		with self._lock:
+			if self._records is None:
+				session, result, gray = self._arguments
+				known = self._stored or {}
+				computed = computeMetrics(session, self.strategy, result, gray, [name for name in self.names if name not in known])
+				
+				records = {metric.name : metric for metric in computed}
+				records.update((name, Metric(self.strategy, name, known[name], 0.)) for name in self.names if name in known)
+				
+				cache, key = self._cache
+				if cache is not None and (computed or self._stored is None):
+					values = dict(known, Time=self.time)
+					values.update((metric.name, metric.value) for metric in computed)
+					cache.put(key, result, values)
+				
+				# The images are not needed anymore
+				self._arguments = None
+				self._records = [records[name] for name in self.names]
+		
+		return self._records
+	
+	def done(self):
+		"""
+		Return whether the metrics are computed
+		"""
+		return self._records is not None
+	
+	def records(self, timeout = None):
+		"""
+		Return the metrics (list of Metric, in the order of METRICS), waiting for the
+		executor, or computing them on the first call without executor
+		
+		timeout - the number of seconds to wait for the executor (default : no limit)
+		"""
+		if self._future is not None:
+			return self._future.result(timeout)
+		return self._compute()
 	
+	def values(self, timeout = None):
+		"""
+		Return the metrics as a dict {name: float}, with the fusion time in seconds under
+		"Time" (see records)
+		"""
+		values = {"Time" : self.time}
+		values.update((metric.name, metric.value) for metric in self.records(timeout))
+		return values
 	
 if __name__ == '__main__':
 	root = tk.Tk()
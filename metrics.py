@@ -1,84 +1,346 @@
 import numpy as np
 import cv2
 from skimage.measure.entropy import shannon_entropy
-from skimage.measure import compare_ssim 
 from scipy.ndimage.filters import gaussian_filter
-from scipy.ndimage.filters import convolve
 from scipy.ndimage.filters import correlate
 from scipy.fftpack import fftshift
 
-def IQI(X, Y):
+# Number of bins of the histograms the entropies are computed on, or "exact" for the
+# entropy of skimage (one bin per distinct value, found by sorting the values)
+ENTROPY_BINS = 256
+
+# Size of the blocks of the Image Quality Index, and of the windows of the Structural
+# Similarity index (the ones of skimage)
+IQI_BLOCK = 8
+SSIM_WINDOW = 7
+
+# Number of rows of the bands the Spatial Frequency is computed on
+SPATIAL_BAND = 256
+
+def integral(I, margin = IQI_BLOCK // 2):
 	"""
-	Calculate the Image Quality Index of an image compared to a reference image
+	Compute the integral image of an image mirrored by margin pixels on each side (as
+	scipy.ndimage does with mode 'reflect'), channel by channel
 	
-	X - the image
-	Y - the reference image
+	I 		- the image
+	margin 	- the number of pixels mirrored on each side
 	
 	
-	Return the Image Quality Index of X - IQI(X) ∈ [-1, 1]
-	Note that a value out of those boundaries indicates that the image are too
-	different to be comparable.
+	Return the integral image S (float64), S[i, j] being the sum of the pixels of the
+	mirrored image above and to the left of (i, j)
 	"""
-	def __conv(x):
-		window = np.ones((BLOCK_SIZE, BLOCK_SIZE))
-		if len(x.shape) < 3:
-			return convolve(x, window)
-		else:
-			channels = x.shape[2]
-			f = [convolve(x[:, :, c], window) for c in range(channels)]
-			return np.array(f)
+	padded = cv2.copyMakeBorder(I, margin, margin, margin, margin, cv2.BORDER_REFLECT)
+	S = cv2.integral(padded, sdepth=cv2.CV_64F)
+	return S.reshape(S.shape[:2] + I.shape[2:])
 
-	def __get_filtered(im1, im2, BLOCK_SIZE):
-		(im1im1, im2im2, im1im2) = (im1 * im1, im2 * im2, im1 * im2)
-		(b1, b2, b3, b4, b5) = map(__conv, (im1, im2, im1im1, im2im2, im1im2))
-		(b6, b7) = (b1 * b2, b1 * b1 + b2 * b2)
-		return (b1, b2, b3, b4, b5, b6, b7)
+def boxSums(S, size, start, count):
+	"""
+	Sum the pixels of square windows from an integral image
+	
+	S 		- the integral image
+	size 	- the side of the windows
+	start 	- the first row and column of the first window, in the mirrored image
+	count 	- the number of windows along each axis (rows, columns)
+	
+	
+	Return the sums, window (i, j) starting at (start + i, start + j)
+	"""
+	(rows, columns), end = count, start + size
+	return (S[end:end + rows, end:end + columns] - S[start:start + rows, end:end + columns]
+			- S[end:end + rows, start:start + columns] + S[start:start + rows, start:start + columns])
 
-	def __get_quality_map(b1, b2, b3, b4, b5, b6, b7, BLOCK_SIZE):
-		N = BLOCK_SIZE * BLOCK_SIZE
-		numerator = 4.0 * (N * b5 - b6) * b6
-		denominator1 = N * (b3 + b4) - b7
+class LocalStatistics:
+	"""
+	Local moments of a reference image and of the images compared to it, from which
+	the Image Quality Index and the Structural Similarity index are computed.
+	
+	The sums of the pixels, of their squares and of the products of both images are
+	integral images, from which the sums over the blocks of IQI and over the windows of
+	SSIM are read in constant time. Those of the reference are computed once, and those
+	of an image compared to it once for both metrics, and released once both are
+	computed. The sums of 8 bits images are exact in double precision, and the same as
+	the ones of the filters of scipy.
+	"""
+	
+	def __init__(self, X):
+		"""
+		X - the reference image
+		"""
+		self.X = X
+		self._X = self.__wide(X)
+		self.sums = integral(self._X)
+		self.squares = integral(self._X * self._X)
+		
+		self._moments = None
+	
+	@staticmethod
+	def __wide(I):
+		return np.asarray(I, dtype=np.float64)
+	
+	def moments(self, Y):
+		"""
+		Return the integral images of X, Y, X * X, Y * Y and X * Y, the ones of Y being
+		computed on the first call for this image only
+		"""
+		# The image and its moments are a single attribute, read and replaced at once, so
+		# that the metrics of different images can be computed in different threads
+		cached = self._moments
+		if cached is None or cached[0] is not Y:
+			Y_wide = self.__wide(Y)
+			cached = (Y, (self.sums, integral(Y_wide), self.squares, integral(Y_wide * Y_wide), integral(self._X * Y_wide)))
+			self._moments = cached
+		return cached[1]
+	
+	def release(self, Y):
+		"""
+		Free the integral images of Y, once its metrics are computed (those of the reference
+		are kept)
+		"""
+		if self._moments is not None and self._moments[0] is Y:
+			self._moments = None
+	
+	def IQI(self, Y, dtype = 'double'):
+		"""
+		Calculate the Image Quality Index of an image compared to the reference image,
+		on blocks of IQI_BLOCK x IQI_BLOCK pixels
+		
+		Y 		- the image
+		dtype 	- the precision of the computations ('double' or np.float32)
+		
+		
+		Return the Image Quality Index of Y - IQI(Y) ∈ [-1, 1]
+		"""
+		N = IQI_BLOCK * IQI_BLOCK
+		
+		# The block of a pixel is the one of a convolution by an even window : the pixels
+		# [i - 3, i + 5) of each axis for blocks of 8, pixel 0 being at the margin of the
+		# integral images
+		start = IQI_BLOCK // 2 - (IQI_BLOCK // 2 - 1)
+		(b1, b2, b3, b4, b5) = [boxSums(S, IQI_BLOCK, start, self.X.shape[:2]).astype(dtype, copy=False) for S in self.moments(Y)]
+		
+		# (b6, b7) = (b1 * b2, b1 * b1 + b2 * b2), without temporary arrays
+		b6 = b1 * b2
+		b7 = np.multiply(b1, b1, out=b1)
+		b7 += np.multiply(b2, b2, out=b2)
+		
+		# numerator = 4.0 * (N * b5 - b6) * b6
+		numerator = np.multiply(b5, N, out=b5)
+		numerator -= b6
+		numerator *= b6
+		numerator *= 4.0
+		
+		# denominator1 = N * (b3 + b4) - b7
+		denominator1 = np.add(b3, b4, out=b3)
+		denominator1 *= N
+		denominator1 -= b7
 		denominator = denominator1 * b7
+		
+		quality_map = np.ones(denominator.shape, dtype=denominator.dtype)
 		index = np.bitwise_and(denominator1 == 0, b7 != 0)
-		quality_map = np.ones(denominator.shape)
-		quality_map[index] = 2.0 * b6[index] / b7[index]
+		np.divide(2.0 * b6, b7, out=quality_map, where=index)
 		index = (denominator != 0)
-		quality_map[index] = numerator[index] / denominator[index]
-		return quality_map[index]
+		np.divide(numerator, denominator, out=quality_map, where=index)
+		
+		# Channel by channel, the order the values were averaged in before
+		if quality_map.ndim == 3:
+			quality_map, index = np.moveaxis(quality_map, 2, 0), np.moveaxis(index, 2, 0)
+		return quality_map[index].mean()
+	
+	def SSIM(self, Y, dtype = None, data_range = 255):
+		"""
+		Calculate the Structural Similarity index of an image and the reference image, as
+		skimage does : uniform windows of SSIM_WINDOW x SSIM_WINDOW pixels, sample
+		covariances, and the windows crossing the borders left out
+		
+		Y 			- the image
+		dtype 		- the precision of the computations, np.float32 for single precision
+					  (default : double precision)
+		data_range 	- the range of the values of the images
+		
+		
+		Return the Structural Similarity - SSIM(X, Y) ∈ [-1, 1]
+		"""
+		NP = SSIM_WINDOW * SSIM_WINDOW
+		cov_norm = NP / (NP - 1.)
+		count = (self.X.shape[0] - SSIM_WINDOW + 1, self.X.shape[1] - SSIM_WINDOW + 1)
+		dtype = dtype or np.float64
+		
+		# The first window starts on pixel 0, at the margin of the integral images
+		(sx, sy, sxx, syy, sxy) = [boxSums(S, SSIM_WINDOW, IQI_BLOCK // 2, count) for S in self.moments(Y)]
+		
+		# S = ((2 * ux * uy + C1) * (2 * vxy + C2)) / ((ux * ux + uy * uy + C1) * (vx + vy + C2)),
+		# the means being the sums / NP and the variances cov_norm * (NP * sxx - sx * sx) / NP^2 :
+		# both sides are multiplied by NP^4, so that the differences of the variances are
+		# computed on the sums, exactly for 8 bits images, before the precision is reduced
+		C1 = (0.01 * data_range * NP) ** 2
+		C2 = (0.03 * data_range * NP) ** 2
+		
+		product = sx * sy
+		squares = np.multiply(sx, sx, out=sx)
+		squares += np.multiply(sy, sy, out=sy)
+		
+		# 2 * vxy + C2 and vx + vy + C2
+		covariance = np.multiply(sxy, NP, out=sxy)
+		covariance -= product
+		variances = np.add(sxx, syy, out=sxx)
+		variances *= NP
+		variances -= squares
+		
+		numerator = covariance.astype(dtype, copy=False)
+		numerator *= 2 * cov_norm
+		numerator += C2
+		denominator = variances.astype(dtype, copy=False)
+		denominator *= cov_norm
+		denominator += C2
+		
+		# 2 * ux * uy + C1 and ux * ux + uy * uy + C1
+		numerator *= 2 * product.astype(dtype, copy=False) + C1
+		denominator *= squares.astype(dtype, copy=False) + C1
+		
+		S = np.divide(numerator, denominator, out=numerator)
+		
+		# Mean of the SSIM of each channel
+		return float(S.reshape(count + (-1,)).mean(axis=(0, 1), dtype=np.float64).mean())
 
-	BLOCK_SIZE = 8
-	(img1, img2) = (X.astype('double'), Y.astype('double'))
-	(b1, b2, b3, b4, b5, b6, b7) = __get_filtered(img1, img2, BLOCK_SIZE)
-	quality_map = __get_quality_map(b1, b2, b3, b4, b5, b6, b7, BLOCK_SIZE)
-	value = quality_map.mean()
-	return value
+def IQI(X, Y, dtype = 'double', statistics = None):
+	"""
+	Calculate the Image Quality Index of an image compared to a reference image
+	
+	X 			- the image
+	Y 			- the reference image
+	dtype 		- the precision of the computations ('double' or np.float32)
+	statistics 	- the LocalStatistics of X, shared by the metrics of the images compared
+				  to X (optional)
 	
-def SSIM(X, Y):
+	
+	Return the Image Quality Index of X - IQI(X) ∈ [-1, 1]
+	Note that a value out of those boundaries indicates that the image are too
+	different to be comparable.
+	"""
+	return (statistics or LocalStatistics(X)).IQI(Y, dtype)
+
+def SSIM(X, Y, dtype = None, statistics = None):
 	"""
 	Calculate the Structural Similarity index difference of two images
 	
-	X - the first image
-	Y - the second image
+	X 			- the first image
+	Y 			- the second image
+	dtype 		- the precision of the computations, np.float32 for single precision
+				  (default : double precision)
+	statistics 	- the LocalStatistics of X, shared by the metrics of the images compared
+				  to X (optional)
 	
 	
 	Return the Structural Similarity - SSIM(X, Y) ∈ [-1, 1]
 	Note that a value out of those boundaries indicates that the image are too
 	different to be comparable.
 	"""
+	return (statistics or LocalStatistics(X)).SSIM(Y, dtype)
 	
-	return compare_ssim(X, Y, multichannel=True)
-	
-def entr(coeffs):
+def entr(coeffs, bins = None, value_range = None):
 	"""
-	Calculate the Shannon Entropy of an image
+	Calculate the Shannon Entropy of an image, or of coefficients, from the histogram of its
+	values, in linear time. The values of a uint8 image are counted as they are (256 bins
+	of one level, which gives the same entropy as skimage), the other values are divided
+	into bins of equal width between the bounds of value_range, or the minimum and the
+	maximum of the values.
 	
-	coeffs - the image
+	coeffs 		- the image
+	bins 		- the number of bins, or "exact" for one bin per distinct value as skimage
+				  does (default : ENTROPY_BINS)
+	value_range - the bounds (low, high) of the bins, the values out of them being counted
+				  in the first or last bin (default : the minimum and the maximum of the values)
 	
 	
 	Return entropy - H(coeffs) > 0
 	"""
-	return shannon_entropy(coeffs)
+	bins = ENTROPY_BINS if bins is None else bins
+	coeffs = np.asarray(coeffs)
+	
+	if bins == "exact":
+		# Shifted to a minimum of 0, as the strategies did
+		return shannon_entropy(coeffs - coeffs.min())
+	
+	if coeffs.dtype == np.uint8 and bins == 256 and value_range is None:
+		counts = np.bincount(coeffs.ravel(), minlength=256)
+	else:
+		low, high = (coeffs.min(), coeffs.max()) if value_range is None else value_range
+		if not high > low:
+			return 0.
+		
+		# Index of the bin of each value, in the precision of the values
+		index = coeffs.astype(coeffs.dtype if coeffs.dtype.kind == 'f' else np.float32)
+		index -= low
+		index *= bins / float(high - low)
+		index = index.astype(np.intp).ravel()
+		np.clip(index, 0, bins - 1, out=index)
+		counts = np.bincount(index, minlength=bins)
+	
+	p = counts[counts > 0] / float(coeffs.size)
+	return float(-np.sum(p * np.log2(p)))
+	
+
+def gradientSums(X, Y = None, band = SPATIAL_BAND):
+	"""
+	Sum the squared differences of the neighbouring pixels of an image in the four
+	directions of the Spatial Frequency, or the maximum of the squared differences of
+	two images. The images are read by bands of rows overlapping by one row, so that
+	the memory used does not depend on the height of the images. The differences of
+	8 bits images are computed in 8 bits, and their squares summed exactly.
+	
+	X 		- the image
+	Y 		- the second image, of the same shape (optional)
+	band 	- the number of rows of the bands
+	
+	
+	Return the sums along the rows, the columns, the main diagonal and the secondary
+	diagonal, one per channel for a multichannel image
+	"""
+	planes = lambda I: cv2.split(I) if I.ndim == 3 else [I]
+	narrow = X.dtype == np.uint8 and (Y is None or Y.dtype == np.uint8)
+	sums = np.zeros((4, X.shape[2] if X.ndim == 3 else 1))
+	
+	def __sum(first, second):
+		# Sum of the squared differences of the pixels of the slices of the bands of
+		# X, and of Y if given (the maximum of both)
+		if first[0].size == 0:
+			return 0
+		
+		if narrow:
+			if Y is None:
+				return cv2.norm(first[0], second[0], cv2.NORM_L2SQR)
+			return cv2.norm(cv2.max(cv2.absdiff(first[0], second[0]), cv2.absdiff(first[1], second[1])), cv2.NORM_L2SQR)
+		
+		# Other images are truncated to integers
+		squares = (first[0].astype(int) - second[0].astype(int)) ** 2
+		if Y is not None:
+			np.maximum(squares, (first[1].astype(int) - second[1].astype(int)) ** 2, out=squares)
+		return squares.sum()
+	
+	for start in range(0, X.shape[0], band):
+		stop = min(start + band, X.shape[0])
+		# The rows of the band, and the first row of the next band
+		bands = [planes(I[start:stop + 1]) for I in ((X,) if Y is None else (X, Y))]
+		own = stop - start
+		
+		for c, P in enumerate(zip(*bands)):
+			sums[0, c] += __sum([p[:own, 1:] for p in P], [p[:own, :-1] for p in P])
+			sums[1, c] += __sum([p[1:] for p in P], [p[:-1] for p in P])
+			sums[2, c] += __sum([p[1:, 1:] for p in P], [p[:-1, :-1] for p in P])
+			sums[3, c] += __sum([p[1:, :-1] for p in P], [p[:-1, 1:] for p in P])
+	
+	return sums if X.ndim == 3 else sums[:, 0]
+
+def frequencies(X, Y = None):
+	"""
+	Return the mean squared differences along the rows, the columns, the main diagonal
+	and the secondary diagonal of an image, or of two images (see gradientSums)
+	"""
+	H, W = X.shape[:2]
+	row, column, diagonal_m, diagonal_s = gradientSums(X, Y)
 	
+	return (row / (H * (W - 1)), column / ((H - 1) * W),
+			diagonal_m / ((H - 1) * (W - 1)), diagonal_s / ((H - 1) * (W - 1)))
 
 def spatial(I):
 	"""
@@ -89,18 +351,11 @@ def spatial(I):
 	Return the Spatial Frequency - SF(I) > 0
 	"""
 	
-	Input = I.astype(int)
+	row, column, diagonal_m, diagonal_s = frequencies(I)
 	
-	row = (np.diff(Input, axis=1)**2).mean(axis=(0, 1))
-	column = (np.diff(Input, axis=0)**2).mean(axis=(0, 1))
-	
-	# Main Diagonal frequency
-	diagonal_m = (Input[1:, 1:] - Input[:-1, :-1])**2
-	diagonal_m = diagonal_m.mean(axis=(0, 1)) / np.sqrt(2)
-	
-	# Secondary Diagonal frequency
-	diagonal_s = (Input[1:, :-1] - Input[:-1, 1:]) ** 2
-	diagonal_s = diagonal_s.mean(axis=(0, 1)) / np.sqrt(2)
+	# Main and Secondary Diagonal frequencies
+	diagonal_m = diagonal_m / np.sqrt(2)
+	diagonal_s = diagonal_s / np.sqrt(2)
 	
 	# SF = sqrt(RF^2 + CF^2 + MDF^2 + SDF^2)
 	
@@ -116,24 +371,11 @@ def spatial_reference(X, Y):
 	
 	Return the Spatial Frequency - SF(X, Y) > 0
 	"""
-	RefFirst = X.astype(int)
-	RefSecond = Y.astype(int)
-	
-	first = np.diff(RefFirst, axis=1)**2
-	second = np.diff(RefSecond, axis=1)**2
-	row = np.maximum(first, second).mean(axis=(0, 1))
+	# The maximum of the squared differences of both images, in each direction
+	row, column, diagonal_m, diagonal_s = frequencies(X, Y)
 	
-	first = np.diff(RefFirst, axis=0)**2
-	second = np.diff(RefSecond, axis=0)**2
-	column = np.maximum(first, second).mean(axis=(0, 1))
-	
-	first = (RefFirst[1:, 1:] - RefFirst[:-1, :-1])**2
-	second = (RefSecond[1:, 1:] - RefSecond[:-1, :-1])**2
-	diagonal_m = np.maximum(first, second).mean(axis=(0, 1)) / np.sqrt(2)
-
-	first = (RefFirst[1:, :-1] - RefFirst[:-1, 1:]) ** 2
-	second = (RefSecond[1:, :-1] - RefSecond[:-1, 1:]) ** 2
-	diagonal_s = np.maximum(first, second).mean(axis=(0, 1)) / np.sqrt(2)
+	diagonal_m = diagonal_m / np.sqrt(2)
+	diagonal_s = diagonal_s / np.sqrt(2)
 	
 	return np.sqrt(row * column * diagonal_s * diagonal_m)
 	
@@ -0,0 +1,147 @@
+import threading
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import cv2
+import numpy as np
+
+# Number of items read ahead, and of the threads reading or writing them
+PREFETCH_DEPTH = 4
+IO_THREADS = 2
+
+def readImage(path, flags = 1, mmap = True):
+	"""
+	Read an image : an image file decoded by OpenCV, or a raw .npy array (in the channel
+	order of OpenCV, BGR)
+	
+	path 	- the path of the image
+	flags 	- 1 for three channels, 0 for a single channel, as for cv2.imread
+	mmap 	- .npy arrays are memory mapped instead of being read, so that no copy is made
+			  and only the pixels used are read
+	
+	
+	Return the image. Raise IOError if it cannot be read.
+	"""
+	if path.lower().endswith('.npy'):
+		try:
+			I = np.load(path, mmap_mode='r' if mmap else None)
+		except (OSError, ValueError) as e:
+			raise IOError("cannot read " + path + " : " + str(e))
+		
+		# Converted like cv2.imread converts the channels of the images
+		if flags == 0 and I.ndim == 3:
+			I = cv2.cvtColor(I, cv2.COLOR_BGR2GRAY)
+		elif flags == 1 and I.ndim == 2:
+			I = cv2.cvtColor(I, cv2.COLOR_GRAY2BGR)
+		return I
+	
+	I = cv2.imread(path, flags)
+	if I is None:
+		raise IOError("cannot read " + path)
+	return I
+
+def writeImage(path, I):
+	"""
+	Write an image : encoded by OpenCV from its extension, or as a raw .npy array
+	
+	path 	- the path of the image
+	I 		- the image (BGR)
+	
+	
+	Raise IOError if it cannot be written
+	"""
+	if path.lower().endswith('.npy'):
+		np.save(path, I)
+	elif not cv2.imwrite(path, I):
+		raise IOError("cannot write " + path)
+
+def prefetch(items, read, depth = PREFETCH_DEPTH, threads = IO_THREADS):
+	"""
+	Read items ahead on background threads, while the previous ones are processed :
+	OpenCV and NumPy release the GIL while decoding and reading, and the values read are
+	handed over without copies.
+	
+	items 	- the items to read (iterable)
+	read 	- the function reading an item, called as read(item)
+	depth 	- the number of items read ahead
+	threads - the number of threads reading them
+	
+	
+	Yield the tuples (item, value, error) in the order of the items, value being the
+	result of read(item), and error the exception it raised, or None
+	"""
+	items = iter(items)
+	executor = ThreadPoolExecutor(threads)
+	pending = deque((item, executor.submit(read, item)) for item in islice(items, depth))
+	
+	try:
+		while pending:
+			item, future = pending.popleft()
+			pending.extend((following, executor.submit(read, following)) for following in islice(items, 1))
+			
+			try:
+				value, error = future.result(), None
+			except Exception as e:
+				value, error = None, e
+			
+			yield (item, value, error)
+	finally:
+		executor.shutdown(cancel_futures=True)
+
+class Writer:
+	"""
+	Writer of images on background threads, so that encoding them is not on the critical
+	path. At most `pending` images wait to be written, write() blocking until one is
+	written above, which bounds the memory used when the encoding is slower than the
+	production of the images.
+	
+	Used as a context manager, the images are all written at the end of the with block.
+	"""
+	
+	def __init__(self, threads = IO_THREADS, pending = 2 * IO_THREADS):
+		"""
+		threads - the number of threads encoding and writing the images
+		pending - the number of images waiting to be written at most
+		"""
+		self.errors = {}
+		self._executor = ThreadPoolExecutor(threads)
+		self._pending = threading.Semaphore(pending)
+	
+	def write(self, path, I):
+		"""
+		Write an image in the background (see writeImage). The image must not be changed
+		until it is written.
+		
+		
+		Return the concurrent.futures.Future of the write. The errors are also kept in
+		errors, a dict {path: error message}.
+		"""
+		self._pending.acquire()
+		future = self._executor.submit(self.__write, path, I)
+		future.add_done_callback(lambda future: self._pending.release())
+		return future
+	
+	def __write(self, path, I):
+		try:
+			writeImage(path, I)
+		except Exception:
+			self.errors[path] = traceback.format_exc(limit=1).strip()
+			raise
+	
+	def close(self):
+		"""
+		Wait for the images to be written
+		
+		
+		Return errors
+		"""
+		self._executor.shutdown()
+		return self.errors
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, *exc):
+		self.close()
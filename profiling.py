@@ -0,0 +1,135 @@
+import argparse
+import json
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class Profile:
+	"""
+	Timings (and peak memory) of the stages of the fusion pipeline.
+	
+	Each stage is recorded as a dict {"stage", "seconds", "peak_memory", ...} with
+	the labels given to stage() (strategy, wavelet, level, subband, metric, ...).
+	The peak memory is the peak of the memory allocated by Python and NumPy during
+	the stage, above what was allocated when it started (in bytes), or None when
+	memory is not traced. Memory allocated by OpenCV is not seen, and the memory of
+	stages run in other threads than the one that created the profile (e.g. the
+	subbands fused concurrently) is not traced, as the peak is global.
+	"""
+	
+	def __init__(self, memory = False):
+		"""
+		memory - trace the peak memory of the stages (slower)
+		"""
+		self.records = []
+		self.memory = memory
+		self._stack = []
+		self._thread = threading.get_ident()
+		
+		if memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+	
+	@contextmanager
+	def stage(self, name, **labels):
+		"""
+		Time the code of a with block as a stage
+		
+		name 	- the name of the stage
+		labels 	- the labels of the stage
+		"""
+		record = dict(stage=name, **labels)
+		frame = None
+		
+		if self.memory and threading.get_ident() == self._thread:
+			# Stages can be nested : the peak of the enclosing stage is saved before
+			# the peak is reset for this one
+			current, peak = tracemalloc.get_traced_memory()
+			if self._stack:
+				self._stack[-1][1] = max(self._stack[-1][1], peak)
+			frame = [current, current]
+			self._stack.append(frame)
+			tracemalloc.reset_peak()
+		
+		time_start = time.perf_counter()
+		
+		try:
+			yield record
+		finally:
+			record["seconds"] = time.perf_counter() - time_start
+			record["peak_memory"] = None
+			
+			if frame is not None:
+				frame[1] = max(frame[1], tracemalloc.get_traced_memory()[1])
+				record["peak_memory"] = frame[1] - frame[0]
+				self._stack.pop()
+				if self._stack:
+					self._stack[-1][1] = max(self._stack[-1][1], frame[1])
+				tracemalloc.reset_peak()
+			
+			self.records.append(record)
+	
+	def totals(self, *keys):
+		"""
+		Sum the timings of the records by stage and the labels given
+		
+		keys - the labels to group by, besides the stage (e.g. "strategy")
+		
+		
+		Return a dict {(stage, label...): seconds}
+		"""
+		totals = {}
+		for record in self.records:
+			key = (record["stage"],) + tuple(record.get(k) for k in keys)
+			totals[key] = totals.get(key, 0.) + record["seconds"]
+		return totals
+	
+	def toJSON(self, path = None):
+		"""
+		Export the records to JSON
+		
+		path - the file to write to (optional)
+		
+		
+		Return the JSON string
+		"""
+		text = json.dumps(self.records, indent=1)
+		if path:
+			with open(path, 'w') as f:
+				f.write(text)
+		return text
+
+class NullProfile:
+	"""
+	Profile that records nothing, used when no profiling is asked
+	"""
+	memory = False
+	records = []
+	
+	@contextmanager
+	def stage(self, name, **labels):
+		yield {}
+
+NO_PROFILE = NullProfile()
+
+if __name__ == '__main__':
+	from main import main, STRATEGIES
+	from pywt import families
+	
+	parser = argparse.ArgumentParser(description="Profile the stages of the fusion of a pair of images")
+	parser.add_argument('rgb', help="RGB image")
+	parser.add_argument('ir', help="IR image")
+	parser.add_argument('-s', '--strategy', default='All', choices=["All"] + STRATEGIES)
+	parser.add_argument('-w', '--wavelet', default='db', choices=families()[:7])
+	parser.add_argument('-m', '--memory', action='store_true', help="trace the peak memory of the stages")
+	parser.add_argument('-o', '--output', default=None, help="JSON file of the records")
+	args = parser.parse_args()
+	
+	profile = Profile(args.memory)
+	main(args.rgb, args.ir, args.strategy, args.wavelet, profile)
+	
+	for (stage, strategy), seconds in sorted(profile.totals("strategy").items(), key=lambda t: -t[1]):
+		print("%-10s %-10s %.4fs" % (stage, strategy or "", seconds))
+	
+	if args.output:
+		profile.toJSON(args.output)
@@ -0,0 +1,273 @@
+import argparse
+import json
+import math
+import os
+import tempfile
+import threading
+
+import cv2
+import numpy as np
+
+# Parameters of the transforms : translation (in pixels of the fixed image), rotation
+# (in radians) and logarithm of the scale
+TRANSFORMS = {
+	"translation" 	: (True, True, False, False),
+	"rigid" 		: (True, True, True, False),
+	"similarity" 	: (True, True, True, True),
+}
+
+# Initial steps of the search of each parameter, at the full resolution
+STEPS = np.array([8., 8., 0.05, 0.05])
+
+# Smallest side of the coarsest level of the pyramids, in pixels : smaller images do
+# not have enough pixels for the joint histogram
+MIN_SIZE = 128
+
+def transformMatrix(params, fixed_shape, moving_shape, level = 0):
+	"""
+	Build the affine matrix mapping the moving image to the fixed image : the moving image
+	is scaled and rotated around its center, which is then placed at the center of the
+	fixed image, translated by (tx, ty)
+	
+	params 			- the parameters (tx, ty, angle, log_scale)
+	fixed_shape 	- the shape of the fixed image, at the full resolution
+	moving_shape 	- the shape of the moving image, at the full resolution
+	level 			- the level of the pyramid the matrix is for (the images being
+					  downscaled by 2^level)
+	
+	
+	Return the 2 x 3 matrix, for cv2.warpAffine
+	"""
+	tx, ty, angle, log_scale = params
+	factor = 0.5**level
+	
+	cf = np.array([(fixed_shape[1] - 1) / 2., (fixed_shape[0] - 1) / 2.]) * factor
+	cm = np.array([(moving_shape[1] - 1) / 2., (moving_shape[0] - 1) / 2.]) * factor
+	
+	scale = math.exp(log_scale)
+	A = scale * np.array([[math.cos(angle), -math.sin(angle)], [math.sin(angle), math.cos(angle)]])
+	t = cf + np.array([tx, ty]) * factor - A.dot(cm)
+	
+	return np.hstack([A, t[:, None]])
+
+def mutualInformation(fixed, warped, mask, bins = 32):
+	"""
+	Compute the normalized mutual information (H(fixed) + H(warped)) / H(fixed, warped) of
+	two images quantized on bins levels, which unlike the mutual information does not
+	favor transforms that reduce the overlap of the images
+	
+	fixed 	- the fixed image, quantized (integers in [0, bins))
+	warped 	- the warped moving image, quantized
+	mask 	- the pixels where the warped image is defined
+	bins 	- the number of levels of the images
+	
+	
+	Return the normalized mutual information, in [1, 2]
+	"""
+	joint = np.bincount(fixed[mask] * bins + warped[mask], minlength=bins * bins).reshape(bins, bins)
+	joint = joint / float(max(1, joint.sum()))
+	
+	def __entropy(p):
+		p = p[p > 0]
+		return -np.sum(p * np.log(p))
+	
+	joint_entropy = __entropy(joint.ravel())
+	if joint_entropy == 0:
+		return 1.
+	return float((__entropy(joint.sum(axis=1)) + __entropy(joint.sum(axis=0))) / joint_entropy)
+
+def quantize(I, bins = 32):
+	"""
+	Quantize an image on bins levels, between its minimum and its maximum
+	"""
+	I = I.astype(np.float32)
+	low, high = I.min(), I.max()
+	return np.minimum((I - low) * (bins / max(high - low, 1e-6)), bins - 1).astype(np.intp)
+
+def pyramid(I, levels):
+	"""
+	Return the gaussian pyramid of an image, from the full resolution to the coarsest level
+	"""
+	images = [I]
+	for _ in range(levels - 1):
+		images.append(cv2.pyrDown(images[-1]))
+	return images
+
+def gray(I):
+	"""
+	Return a float32 grayscale version of an image (BGR or already grayscale)
+	"""
+	if I.ndim == 3:
+		I = cv2.cvtColor(I, cv2.COLOR_BGR2GRAY)
+	return I.astype(np.float32)
+
+def estimateTransform(fixed, moving, transform = "rigid", levels = 4, bins = 32, min_step = 0.05, initial = None):
+	"""
+	Estimate the transform registering the moving image (IR) onto the fixed image (RGB) by
+	maximizing their mutual information, coarse to fine : the parameters are searched on the
+	coarsest level of a gaussian pyramid of both images, then refined on each finer level.
+	The search at each level is a compass search : each parameter is moved by its step in
+	both directions, the steps being halved when no move improves the mutual information.
+	
+	fixed 		- the fixed image
+	moving 		- the moving image
+	transform 	- the kind of transform : "translation", "rigid" or "similarity"
+	levels 		- the number of levels of the pyramid
+	bins 		- the number of levels the images are quantized on
+	min_step 	- the search stops when the steps are min_step times the initial steps (times
+				  2^level on the coarser levels)
+	initial 	- the initial parameters (tx, ty, angle, log_scale) (default : the centers of
+				  both images aligned, and for a similarity the moving image scaled to the
+				  width of the fixed image)
+	
+	
+	Return the 2 x 3 matrix mapping the moving image to the fixed image, for cv2.warpAffine
+	"""
+	if transform not in TRANSFORMS:
+		raise ValueError("unknown transform %r, expected one of %s" % (transform, ", ".join(TRANSFORMS)))
+	
+	free = np.array(TRANSFORMS[transform])
+	fixed, moving = gray(fixed), gray(moving)
+	
+	if initial is None:
+		initial = [0., 0., 0., math.log(fixed.shape[1] / float(moving.shape[1])) if free[3] else 0.]
+	params = np.array(initial, dtype=float)
+	
+	# Levels that would make the images smaller than MIN_SIZE are skipped
+	levels = max(1, min(levels, int(math.log2(max(1., min(fixed.shape[:2] + moving.shape[:2]) / float(MIN_SIZE)))) + 1))
+	fixed_pyramid = pyramid(fixed, levels)
+	moving_pyramid = pyramid(moving, levels)
+	
+	for level in reversed(range(levels)):
+		# Less levels on the coarser levels of the pyramid, which have less pixels to
+		# fill the joint histogram
+		level_bins = max(8, bins >> level)
+		F = quantize(fixed_pyramid[level], level_bins)
+		# The moving image is quantized before being warped, so that its levels do
+		# not depend on the part of it that is warped
+		M = quantize(moving_pyramid[level], level_bins).astype(np.float32)
+		size = (F.shape[1], F.shape[0])
+		
+		def __cost(p):
+			matrix = transformMatrix(p, fixed.shape, moving.shape, level)
+			# Pixels outside of the moving image are marked with -1
+			warped = cv2.warpAffine(M, matrix, size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=-1)
+			mask = warped >= 0
+			if mask.sum() < 0.5 * mask.size:
+				return 0.
+			return mutualInformation(F, warped.astype(np.intp), mask, level_bins)
+		
+		# The translation steps are in pixels of the level, and the parameters are only
+		# refined to the precision the level can give
+		steps = STEPS * np.array([2.**level, 2.**level, 1., 1.]) * free
+		stop = min_step * STEPS * 2.**level
+		best = __cost(params)
+		
+		while np.any(steps[free] >= stop[free]):
+			improved = False
+			for k in np.flatnonzero(steps):
+				for sign in (1, -1):
+					candidate = params.copy()
+					candidate[k] += sign * steps[k]
+					value = __cost(candidate)
+					if value > best:
+						params, best, improved = candidate, value, True
+						break
+			if not improved:
+				steps /= 2
+	
+	return transformMatrix(params, fixed.shape, moving.shape)
+
+def warp(moving, matrix, shape):
+	"""
+	Warp the moving image onto the frame of the fixed image
+	
+	moving 	- the moving image
+	matrix 	- the 2 x 3 matrix mapping the moving image to the fixed image
+	shape 	- the shape of the fixed image
+	
+	
+	Return the registered image, of the size of the fixed image
+	"""
+	return cv2.warpAffine(moving, np.asarray(matrix, dtype=np.float64), (shape[1], shape[0]), flags=cv2.INTER_LINEAR)
+
+class TransformCache:
+	"""
+	Transforms estimated for each camera rig or sequence, so that the following frames
+	of a same rig are only warped. The transforms can be saved to a JSON file, written
+	to a temporary file then renamed so that readers never see a partial file.
+	"""
+	
+	def __init__(self, path = None):
+		"""
+		path - the JSON file of the transforms, loaded if it exists (optional)
+		"""
+		self.path = path
+		self.transforms = {}
+		self._lock = threading.Lock()
+		
+		if path and os.path.exists(path):
+			with open(path) as f:
+				self.transforms = {key: np.array(matrix) for key, matrix in json.load(f).items()}
+	
+	def get(self, key):
+		"""
+		Return the matrix of the rig key, or None
+		"""
+		return self.transforms.get(key)
+	
+	def put(self, key, matrix):
+		"""
+		Store the matrix of the rig key, and save the transforms if the cache has a path
+		"""
+		with self._lock:
+			self.transforms[key] = np.asarray(matrix)
+			
+			if self.path:
+				fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(os.path.abspath(self.path)))
+				with os.fdopen(fd, 'w') as f:
+					json.dump({k: m.tolist() for k, m in self.transforms.items()}, f, indent=1)
+				os.replace(tmp_path, self.path)
+
+def register(fixed, moving, key = None, cache = None, transform = "rigid", **options):
+	"""
+	Register the moving image (IR) onto the fixed image (RGB), as ImageRegistration.m does.
+	The transform of a rig is only estimated for its first pair when a cache is given.
+	
+	fixed 		- the fixed image
+	moving 		- the moving image
+	key 		- the camera rig or sequence of the pair, the transform being cached
+				  only when it is given (optional)
+	cache 		- the TransformCache of the rigs (optional)
+	transform 	- the kind of transform : "translation", "rigid" or "similarity"
+	options 	- the options of estimateTransform
+	
+	
+	Return the registered image, of the size of the fixed image
+	"""
+	cached = cache is not None and key is not None
+	matrix = cache.get(key) if cached else None
+	
+	if matrix is None:
+		matrix = estimateTransform(fixed, moving, transform, **options)
+		if cached:
+			cache.put(key, matrix)
+	
+	return warp(moving, matrix, fixed.shape)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Register an IR image onto an RGB image (mutual information, coarse to fine)")
+	parser.add_argument('rgb', help="RGB image (fixed)")
+	parser.add_argument('ir', help="IR image (moving)")
+	parser.add_argument('output', help="registered IR image")
+	parser.add_argument('-t', '--transform', default='rigid', choices=list(TRANSFORMS))
+	parser.add_argument('-l', '--levels', type=int, default=4, help="number of levels of the pyramid")
+	parser.add_argument('-c', '--cache', default=None, help="JSON file of the transforms of the rigs")
+	parser.add_argument('-k', '--key', default=None, help="camera rig or sequence of the pair, its transform being reused from the cache")
+	args = parser.parse_args()
+	
+	fixed = cv2.imread(args.rgb, 1)
+	moving = cv2.imread(args.ir, 1)
+	
+	cache = TransformCache(args.cache) if args.cache else None
+	cv2.imwrite(args.output, register(fixed, moving, args.key, cache, args.transform, levels=args.levels))
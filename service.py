@@ -0,0 +1,476 @@
+import argparse
+import json
+import os
+import socketserver
+import stat
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import numpy as np
+from pywt import families
+from fuse import FusionSession, COLOR_SPACES
+from main import fuseImage, selectStrategy, METRICS, AUTO
+from strategies import strategyNames
+from prefetch import readImage, writeImage
+
+# Largest number of requests fused by a worker in one call, and the time the dispatcher
+# waits for more requests once it has one, in seconds
+BATCH_SIZE = 8
+BATCH_WINDOW = 0.002
+
+# Only the first wavelets are functionnal (see GUI.Window), the others are continuous
+WAVELETS = families()[:7]
+
+# Number of the last requests the latency percentiles are computed on, and the period
+# the throughput is measured over, in seconds
+HISTORY = 1000
+THROUGHPUT_PERIOD = 60.
+
+# Time a request waits for its result before the service answers 503, in seconds
+REQUEST_TIMEOUT = 300.
+
+FORMATS = {"png" : "image/png", "jpg" : "image/jpeg", "bmp" : "image/bmp", "tiff" : "image/tiff"}
+
+def decodeImage(source, flags):
+	"""
+	Read an image from the bytes of an encoded image, or from a path (see prefetch.readImage)
+	"""
+	if not isinstance(source, bytes):
+		return readImage(source, flags)
+	
+	I = cv2.imdecode(np.frombuffer(source, np.uint8), flags)
+	if I is None:
+		raise IOError("cannot read the image sent")
+	return I
+
+def warm():
+	"""
+	Fuse a small pair with every strategy and compute every metric, so that the modules
+	are imported and loaded before the first request. Runs in the worker processes.
+	"""
+	I = np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+	session = FusionSession(I, I[::-1].copy())
+	
+	for strategy in strategyNames():
+		fuseImage(session.I1, session.I2, strategy, 'db', session)[1].values()
+
+def fuseBatch(jobs):
+	"""
+	Fuse a batch of requests. Runs in the worker processes : the requests on the same
+	pair (same images, precision and color space) share a FusionSession, which
+	decomposes the images once.
+	
+	jobs - the requests, dicts {"rgb", "ir", "strategy", "wavelet", "dtype", "color",
+		   "metrics", "criterion", "format", "output"}, rgb and ir being paths or encoded
+		   images
+	
+	
+	Return a list of tuples (data, strategy, values, error), one per request : the encoded
+	fused image (None if it was written to the output path), the strategy applied (the one
+	chosen with "Auto"), the metrics of the image (see main.fuseMetrics) and the error
+	raised, or None
+	"""
+	sessions = {}
+	results = []
+	
+	for job in jobs:
+		try:
+			key = (job["rgb"], job["ir"], job["dtype"], job["color"])
+			if key not in sessions:
+				I1 = decodeImage(job["rgb"], 1)
+				I2 = decodeImage(job["ir"], 1 if job["color"] is None else 0)
+				sessions[key] = FusionSession(I1, I2, dtype=job["dtype"], color=job["color"])
+			session = sessions[key]
+			
+			strategy = job["strategy"]
+			if strategy == AUTO:
+				strategy = selectStrategy(session, job["wavelet"], job["criterion"])[0]
+			
+			result, measures = fuseImage(session.I1, session.I2, strategy, job["wavelet"], session, metrics=job["metrics"])
+			result = cv2.cvtColor(result, cv2.COLOR_RGB2BGR)
+			
+			data = None
+			if job["output"]:
+				writeImage(job["output"], result)
+			else:
+				data = cv2.imencode("." + job["format"], result)[1].tobytes()
+			
+			results.append((data, strategy, measures.values(), None))
+		
+		except Exception:
+			results.append((None, None, None, traceback.format_exc(limit=1).strip()))
+	
+	return results
+
+class FusionService:
+	"""
+	Fusion of the requests of a local service by a pool of warm worker processes.
+	
+	The requests are queued, and a dispatcher thread sends them to the workers : when
+	all the workers are busy, the requests waiting are sent together as one batch once a
+	worker is free, which saves the round trips to the processes under load, and lets
+	the requests on the same pair share its decompositions.
+	
+	When a worker process dies, the requests of the batches it was given fail, and the
+	pool is started and warmed up again before the next batch is sent.
+	"""
+	
+	def __init__(self, workers = None, batch_size = BATCH_SIZE, window = BATCH_WINDOW, timeout = REQUEST_TIMEOUT):
+		"""
+		workers 	- the number of worker processes (default : the number of CPUs)
+		batch_size 	- the largest number of requests in a batch
+		window 		- the time the dispatcher waits for more requests once it has one,
+					  in seconds (0 to only batch the requests already waiting)
+		timeout 	- the time the HTTP handlers wait for the result of a request, in seconds
+		"""
+		self.workers = workers or os.cpu_count()
+		self.batch_size = batch_size
+		self.window = window
+		self.timeout = timeout
+		
+		self._queue = Queue()
+		self._slots = threading.Semaphore(self.workers)
+		self._lock = threading.Lock()
+		self._executor = None
+		self._broken = False
+		self._dispatcher = None
+		
+		self._started = None
+		self._in_flight = 0
+		self._requests = 0
+		self._errors = 0
+		self._batches = 0
+		self._latencies = deque(maxlen=HISTORY)
+		self._completed = deque()
+	
+	def start(self):
+		"""
+		Start the worker processes, importing the modules and fusing a small pair in each
+		of them, then the dispatcher
+		"""
+		self._executor = self._pool()
+		
+		self._started = time.monotonic()
+		self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+		self._dispatcher.start()
+	
+	def close(self):
+		"""
+		Stop the dispatcher once the requests queued are sent, and the worker processes
+		once they are fused
+		"""
+		self._queue.put(None)
+		self._dispatcher.join()
+		self._executor.shutdown()
+	
+	def _pool(self):
+		executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm)
+		# The processes are started by the first tasks, all at once as none is idle yet
+		for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+			future.result()
+		return executor
+	
+	def _restart(self):
+		# The pool is broken once one of its processes died : it cannot run any task anymore
+		self._executor.shutdown(wait=False, cancel_futures=True)
+		self._executor = self._pool()
+		self._broken = False
+	
+	def submit(self, job):
+		"""
+		Queue a request (see fuseBatch)
+		
+		
+		Return a concurrent.futures.Future of the tuple (data, strategy, values, error) of the
+		request, or of the exception raised if it could not be fused (e.g. the worker process
+		died)
+		"""
+		future = Future()
+		self._queue.put((job, future, time.monotonic()))
+		return future
+	
+	def _dispatch(self):
+		while True:
+			# A batch is only gathered once a worker is free to fuse it
+			self._slots.acquire()
+			
+			request = self._queue.get()
+			if request is None:
+				return
+			
+			batch = [request]
+			deadline = time.monotonic() + self.window
+			
+			while len(batch) < self.batch_size:
+				try:
+					request = self._queue.get(timeout=max(0., deadline - time.monotonic()))
+				except Empty:
+					break
+				
+				if request is None:
+					# Stop once this batch is sent
+					self._queue.put(None)
+					break
+				batch.append(request)
+			
+			with self._lock:
+				self._in_flight += len(batch)
+				self._batches += 1
+			
+			try:
+				if self._broken:
+					self._restart()
+				future = self._executor.submit(fuseBatch, [job for job, _, _ in batch])
+			except Exception as e:
+				self._broken = self._broken or isinstance(e, BrokenProcessPool)
+				self._slots.release()
+				self._finish(batch, error=e)
+				continue
+			
+			future.add_done_callback(lambda future, batch = batch: self._done(batch, future))
+	
+	def _done(self, batch, future):
+		self._slots.release()
+		
+		try:
+			results = future.result()
+		except Exception as e:
+			# The worker process died : the pool is started again by the dispatcher
+			self._broken = self._broken or isinstance(e, BrokenProcessPool)
+			self._finish(batch, error=e)
+		else:
+			self._finish(batch, results)
+		
+	def _finish(self, batch, results = None, error = None):
+		# The requests of the batch get their results, or all fail with error
+		now = time.monotonic()
+		with self._lock:
+			self._in_flight -= len(batch)
+			
+			for n, (_, _, received) in enumerate(batch):
+				self._requests += 1
+				self._errors += error is not None or results[n][3] is not None
+				self._latencies.append(now - received)
+				self._completed.append(now)
+			
+			while self._completed and self._completed[0] < now - THROUGHPUT_PERIOD:
+				self._completed.popleft()
+		
+		for n, (_, request, _) in enumerate(batch):
+			if error is not None:
+				request.set_exception(error)
+			else:
+				request.set_result(results[n])
+	
+	def stats(self):
+		"""
+		Return the statistics of the service (dict) : the requests waiting for a worker
+		("queue") and being fused ("in_flight"), the number of requests, errors and
+		batches, the percentiles of the latency of the last HISTORY requests, from their
+		arrival to their result, in seconds, and the requests fused per second over the
+		last THROUGHPUT_PERIOD seconds
+		"""
+		now = time.monotonic()
+		
+		with self._lock:
+			latencies = np.array(self._latencies)
+			period = min(THROUGHPUT_PERIOD, now - self._started)
+			recent = sum(1 for t in self._completed if t >= now - THROUGHPUT_PERIOD)
+			
+			return {"workers" : self.workers, "queue" : self._queue.qsize(), "in_flight" : self._in_flight,
+					"requests" : self._requests, "errors" : self._errors, "batches" : self._batches,
+					"mean_batch" : self._requests / self._batches if self._batches else 0.,
+					"latency" : {"p%d" % p : float(np.percentile(latencies, p)) if latencies.size else None for p in (50, 90, 99)},
+					"throughput" : recent / period if period > 0 else 0., "uptime" : now - self._started}
+
+def parseRequest(query, content_type, body):
+	"""
+	Read the parameters and the images of a fusion request
+	
+	query 			- the parameters of the URL (dict {name: [values]}) : strategy ("Auto" for
+					  the one chosen by the metric criterion, see main.selectStrategy), wavelet,
+					  metrics (comma separated, empty for none), criterion, color, float32 and
+					  format
+	content_type 	- the Content-Type of the body : multipart/form-data with the encoded
+					  images as the parts rgb and ir, or application/json with the paths of
+					  the images {"rgb", "ir"} and optionally the path the fused image is
+					  written to {"output"}
+	body 			- the body of the request
+	
+	
+	Return the request as a job of fuseBatch. Raise ValueError on an invalid request.
+	"""
+	parameter = lambda name, default = None: query.get(name, [default])[-1]
+	
+	job = {"strategy" : parameter("strategy", "Mean"), "wavelet" : parameter("wavelet", "db"),
+		   "color" : parameter("color") or None, "format" : parameter("format", "png"), "output" : None,
+		   "criterion" : parameter("criterion", "SSIM"),
+		   "dtype" : np.float32 if parameter("float32", "0") not in ("0", "false", "") else None}
+	
+	names = parameter("metrics")
+	job["metrics"] = METRICS if names is None else tuple(name for name in names.split(",") if name)
+	
+	if job["strategy"] not in strategyNames() + [AUTO]:
+		raise ValueError("unknown strategy %r" % job["strategy"])
+	if job["criterion"] not in METRICS:
+		raise ValueError("unknown criterion %r" % job["criterion"])
+	if job["wavelet"] not in WAVELETS:
+		raise ValueError("unknown wavelet %r" % job["wavelet"])
+	if job["color"] is not None and job["color"] not in COLOR_SPACES:
+		raise ValueError("unknown color space %r" % job["color"])
+	if job["format"] not in FORMATS:
+		raise ValueError("unknown format %r" % job["format"])
+	if any(name not in METRICS for name in job["metrics"]):
+		raise ValueError("unknown metrics %r" % names)
+	
+	if content_type.startswith("multipart/form-data"):
+		message = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+		parts = {part.get_param("name", header="content-disposition") : part.get_payload(decode=True)
+				 for part in message.iter_parts()}
+	elif content_type.startswith("application/json"):
+		parts = json.loads(body)
+		if not isinstance(parts, dict):
+			raise ValueError("the JSON body must be an object")
+		job["output"] = parts.get("output")
+	else:
+		raise ValueError("unsupported Content-Type %r" % content_type)
+	
+	if not (parts.get("rgb") and parts.get("ir")):
+		raise ValueError("the rgb and ir images are required")
+	
+	job["rgb"], job["ir"] = parts["rgb"], parts["ir"]
+	return job
+
+class FusionHandler(BaseHTTPRequestHandler):
+	"""
+	HTTP interface of the FusionService of the server :
+	
+	POST /fuse 			- fuse a pair (see parseRequest). The response is the fused image, its
+						  metrics being the JSON header X-Fusion-Metrics and its strategy the
+						  header X-Fusion-Strategy, or both as JSON when the image is written
+						  to an output path
+	GET /stats 			- the statistics of the service (see FusionService.stats)
+	GET /strategies 	- the strategies, wavelets, metrics and color spaces available
+	"""
+	protocol_version = "HTTP/1.1"
+	
+	def address_string(self):
+		# Clients of a Unix socket have no address
+		return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+	
+	def _send(self, code, body, content_type = "application/json", headers = {}):
+		if not isinstance(body, bytes):
+			body = json.dumps(body).encode()
+		
+		self.send_response(code)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Content-Length", str(len(body)))
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.end_headers()
+		self.wfile.write(body)
+	
+	def do_GET(self):
+		path = urlparse(self.path).path
+		
+		if path == "/stats":
+			self._send(200, self.server.service.stats())
+		elif path == "/strategies":
+			self._send(200, {"strategies" : strategyNames() + [AUTO], "wavelets" : WAVELETS, "metrics" : list(METRICS),
+							 "colors" : list(COLOR_SPACES), "formats" : list(FORMATS)})
+		else:
+			self._send(404, {"error" : "unknown path " + path})
+	
+	def do_POST(self):
+		url = urlparse(self.path)
+		body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+		
+		if url.path != "/fuse":
+			self._send(404, {"error" : "unknown path " + url.path})
+			return
+		
+		try:
+			job = parseRequest(parse_qs(url.query, keep_blank_values=True), self.headers.get("Content-Type", ""), body)
+		except ValueError as e:
+			self._send(400, {"error" : str(e)})
+			return
+		
+		service = self.server.service
+		try:
+			data, strategy, values, error = service.submit(job).result(service.timeout)
+		except TimeoutError:
+			self._send(503, {"error" : "the request was not fused within %g seconds" % service.timeout})
+			return
+		except Exception as e:
+			self._send(500, {"error" : "%s: %s" % (type(e).__name__, e)})
+			return
+		
+		if error is not None:
+			self._send(500, {"error" : error})
+		elif data is None:
+			self._send(200, {"output" : job["output"], "strategy" : strategy, "metrics" : values})
+		else:
+			self._send(200, data, FORMATS[job["format"]], {"X-Fusion-Strategy" : strategy, "X-Fusion-Metrics" : json.dumps(values)})
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+def serve(service, host = "127.0.0.1", port = 8765, unix = None):
+	"""
+	Serve the requests of a started FusionService over HTTP until interrupted
+	
+	service - the FusionService
+	host 	- the address to listen on, localhost by default
+	port 	- the port to listen on
+	unix 	- the path of a Unix socket to listen on instead (optional)
+	"""
+	if unix:
+		# The socket of a previous server is replaced
+		if os.path.exists(unix) and stat.S_ISSOCK(os.stat(unix).st_mode):
+			os.unlink(unix)
+		server = UnixHTTPServer(unix, FusionHandler)
+	else:
+		server = ThreadingHTTPServer((host, port), FusionHandler)
+	
+	server.service = service
+	print("Fusion service listening on " + (unix or "http://%s:%d" % (host, port)))
+	
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if unix:
+			os.unlink(unix)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Local fusion service over HTTP, with a pool of warm worker processes")
+	parser.add_argument('--host', default='127.0.0.1', help="address to listen on")
+	parser.add_argument('-p', '--port', type=int, default=8765, help="port to listen on")
+	parser.add_argument('-u', '--unix', default=None, help="path of a Unix socket to listen on instead of a port")
+	parser.add_argument('-j', '--workers', type=int, default=None, help="number of worker processes (default : number of CPUs)")
+	parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, help="largest number of requests fused by a worker at once")
+	parser.add_argument('--batch-window', type=float, default=BATCH_WINDOW * 1000,
+						help="time waited for more requests once one is received, in milliseconds")
+	parser.add_argument('-t', '--timeout', type=float, default=REQUEST_TIMEOUT,
+						help="time a request waits for its result before the service answers 503, in seconds")
+	args = parser.parse_args()
+	
+	service = FusionService(args.workers, args.batch_size, args.batch_window / 1000, args.timeout)
+	service.start()
+	
+	try:
+		serve(service, args.host, args.port, args.unix)
+	finally:
+		service.close()
@@ -0,0 +1,175 @@
+import numpy as np
+from collections import OrderedDict
+from functools import partial
+from fusionStrategies import MACD, edgeDetection, deviation, coeffsEntropy
+from fusionStrategies import MACDWeights, MACDCombine, edgeWeights, entropyWeights, weightedMean
+from fusionStrategies import deviationWeights, deviationCombine
+from fusionStrategies import MACDSources, entropySources, edgeSources, deviationSources
+
+class Strategy:
+	"""
+	A fusion strategy and what the engine needs to know to run it efficiently.
+	
+	The function is called as function(coeff1, coeff2) on each subband and returns
+	the fused subband. Strategies that can work in place are also called as
+	function(coeff1, coeff2, out=array).
+	
+	More than two sources are fused at once by the sources function, called as
+	sources(coeffs) on the subbands of the sources stacked along a new first axis.
+	"""
+	
+	def __init__(self, name, function, elementwise = False, dtypes = (np.float64, np.float32),
+				 neighborhood = 0, global_stats = False, inplace = False, weights = None, combine = None,
+				 sources = None, workspace = False):
+		"""
+		name 			- the name of the strategy, as shown in the GUI
+		function 		- the function fusing two subbands
+		elementwise 	- each fused coefficient only depends on the coefficients at the same
+						  position : the subbands are fused in one pass, without threads
+		dtypes 			- the precisions the function supports, the first one being used
+						  for the coefficients of any other precision
+		neighborhood 	- the size, in coefficients, of the neighborhood a fused coefficient
+						  depends on (0 if elementwise), used to size the margins of the tiles
+		global_stats 	- the function uses statistics of the whole subband (e.g. its entropy) :
+						  the result of a tiled fusion is then only an approximation
+		inplace 		- the function accepts an out argument, which may be coeff1
+		weights 		- the function computing the weights of the strategy (the costly part),
+						  weights(coeff1, coeff2), if it can be split (optional). The arrays
+						  returned belong to the caller
+		combine 		- the function fusing two subbands with their weights,
+						  combine(coeff1, coeff2, weights), giving the same result as function.
+						  Video sequences reuse the weights of the previous frames (see temporal)
+		sources 		- the function fusing the stacked subbands of N sources, sources(coeffs),
+						  coeffs being an array (N, ...) (optional : the sources are then fused
+						  two by two, in their order, on the coefficients)
+		workspace 		- the function accepts a workspace argument, the Workspace of the
+						  temporary arrays shared by the subbands of a fusion
+		"""
+		self.name = name
+		self.function = function
+		self.elementwise = elementwise
+		self.dtypes = tuple(np.dtype(dtype) for dtype in dtypes)
+		self.neighborhood = neighborhood
+		self.global_stats = global_stats
+		self.inplace = inplace
+		self.weights = weights
+		self.combine = combine
+		self.sources = sources
+		self.workspace = workspace
+	
+	def __call__(self, coeff1, coeff2, out = None, workspace = None):
+		"""
+		Fuse two subbands, in a precision supported by the function
+		
+		coeff1 	- coefficient of the RGB image
+		coeff2 	- coefficient of the IR image
+		out 		- the array to write the result to, used by in place strategies only (optional)
+		workspace 	- the Workspace of the temporary arrays, used by the strategies taking
+					  one only (optional)
+		
+		
+		Return fused coefficient, in the precision of coeff1
+		"""
+		dtype = coeff1.dtype
+		
+		if dtype not in self.dtypes:
+			coeff1, coeff2, out = coeff1.astype(self.dtypes[0]), coeff2.astype(self.dtypes[0]), None
+		
+		if self.inplace and out is not None:
+			result = self.function(coeff1, coeff2, out=out)
+		elif self.workspace and workspace is not None:
+			result = self.function(coeff1, coeff2, workspace=workspace)
+		else:
+			result = self.function(coeff1, coeff2)
+		
+		return result.astype(dtype, copy=False)
+	
+	def fuseSources(self, coeffs):
+		"""
+		Fuse the stacked subbands of N sources, in a precision supported by the functions.
+		Two sources are fused by the function of the pair.
+		
+		coeffs 	- the coefficients, as an array (N, ...), the visible image first
+		
+		
+		Return fused coefficient, in the precision of coeffs
+		"""
+		if len(coeffs) == 2:
+			return self(coeffs[0], coeffs[1])
+		
+		dtype = coeffs.dtype
+		if dtype not in self.dtypes:
+			coeffs = coeffs.astype(self.dtypes[0])
+		
+		if self.sources is not None:
+			result = self.sources(coeffs)
+		else:
+			result = coeffs[0]
+			for coeff in coeffs[1:]:
+				result = self.function(result, coeff)
+		
+		return result.astype(dtype, copy=False)
+	
+	def __repr__(self):
+		return "Strategy(%r)" % self.name
+
+# The strategies, in the order they are shown
+REGISTRY = OrderedDict()
+
+def registerStrategy(name, **capabilities):
+	"""
+	Register a fusion strategy, as a decorator of the function fusing two subbands :
+	
+		@registerStrategy("Sum", elementwise=True, inplace=True)
+		def fuseSum(coeff1, coeff2, out = None):
+			return np.add(coeff1, coeff2, out=out)
+	
+	name 			- the name of the strategy (an existing strategy of the same name is replaced)
+	capabilities 	- the capabilities of the strategy (see Strategy)
+	
+	
+	Return the decorator, which returns the function unchanged
+	"""
+	def __register(function):
+		REGISTRY[name] = Strategy(name, function, **capabilities)
+		return function
+	return __register
+
+def getStrategy(name):
+	"""
+	Return the Strategy registered under name
+	"""
+	try:
+		return REGISTRY[name]
+	except KeyError:
+		raise ValueError("unknown fusion strategy %r, expected one of %s" % (name, ", ".join(REGISTRY)))
+
+def strategyNames():
+	"""
+	Return the names of the registered strategies
+	"""
+	return list(REGISTRY)
+
+@registerStrategy("Min", elementwise=True, inplace=True, sources=partial(np.min, axis=0))
+def fuseMin(coeff1, coeff2, out = None):
+	return np.minimum(coeff1, coeff2, out=out)
+
+@registerStrategy("Max", elementwise=True, inplace=True, sources=partial(np.max, axis=0))
+def fuseMax(coeff1, coeff2, out = None):
+	return np.maximum(coeff1, coeff2, out=out)
+
+@registerStrategy("Mean", elementwise=True, inplace=True, sources=partial(np.mean, axis=0))
+def fuseMean(coeff1, coeff2, out = None):
+	# (coeff1 + coeff2) / 2, without the temporary array
+	result = np.add(coeff1, coeff2, out=out)
+	result /= 2
+	return result
+
+registerStrategy("Entropy", global_stats=True, weights=entropyWeights, combine=weightedMean,
+				 sources=entropySources)(coeffsEntropy)
+registerStrategy("MACD", neighborhood=5, global_stats=True, weights=MACDWeights, combine=MACDCombine,
+				 sources=MACDSources, workspace=True)(MACD)
+registerStrategy("Edge", neighborhood=3, global_stats=True, weights=edgeWeights, combine=weightedMean,
+				 sources=edgeSources)(edgeDetection)
+registerStrategy("Deviation", neighborhood=4, weights=deviationWeights, combine=deviationCombine,
+				 sources=deviationSources)(deviation)
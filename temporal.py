@@ -0,0 +1,213 @@
+import math
+
+import numpy as np
+from fuse import decompose, reconstruct, normalize, luminance, colorize, LEVEL
+from strategies import getStrategy
+
+# Height of the strips of rows the subbands are divided into, in coefficients : the
+# weights of the local strategies are computed again strip by strip
+STRIP = 32
+
+# Size of the blocks the change of the subbands is measured on, in coefficients
+BLOCK = 8
+
+def weightArrays(weights):
+	"""
+	Return the arrays of the weights of a strategy, as a list
+	"""
+	return [w for w in (weights if isinstance(weights, tuple) else (weights,)) if isinstance(w, np.ndarray)]
+
+class TemporalFusion:
+	"""
+	Fusion of the frames of a video sequence, reusing the weights of the strategy from one
+	frame to the next (the decision maps of MACD, the entropies of Entropy and Edge, the
+	standard deviations of the windows of Deviation).
+	
+	The change of each subband since its weights were computed is measured on blocks of
+	BLOCK x BLOCK coefficients (mean absolute difference, over every coefficient of the block),
+	above the change the noise of the sensors gives (the median change of the blocks, measured
+	on the first frame compared), relative to the mean absolute deviation of the subband.
+	The subbands are divided into strips of STRIP rows, and the weights of the strips with a
+	block that changed by more than threshold are computed again : only these strips for local
+	strategies, the whole subband for the strategies using statistics of the whole subband, or
+	when the median change itself grew by more than threshold (e.g. the lighting changed).
+	Every refresh frames, all the weights are computed again. The strategies without weights
+	(Mean, Min, Max) are applied as usual, and so are by default the strategies using
+	statistics of the whole subband (Entropy, Edge, MACD) : their weights are all stale or
+	all new, and the stale decisions of MACD flip with the noise of the sensors.
+	"""
+	
+	def __init__(self, FUSION_METHOD, wavelet = 'db', level = LEVEL, threshold = 0.5, refresh = 30, dtype = None, color = None,
+				 global_stats = False):
+		"""
+		FUSION_METHOD 	- the fusion strategy to apply to the coefficients
+		wavelet 		- the wavelet to use
+		level 			- the number of decomposition levels
+		threshold 		- the relative change of a block above which the weights of its
+						  strip are computed again
+		refresh 		- the number of frames between two computations of all the weights
+		dtype 			- the precision of the computations, np.float32 for single
+						  precision (default : double precision)
+		color 			- the color space of the luminance fusion, "ycrcb" or "hsv"
+						  (default : the BGR channels are fused)
+		global_stats 	- reuse the weights of the strategies using statistics of the whole
+						  subband too, which then differ from the fusion of each frame
+						  (default : they are computed for every frame)
+		"""
+		self.strategy = getStrategy(FUSION_METHOD)
+		self.wavelet = wavelet
+		self.level = level
+		self.threshold = threshold
+		self.refresh = refresh
+		self.dtype = dtype
+		self.color = color
+		self.global_stats = global_stats
+		
+		self.frames = 0
+		self.computed = 0
+		self.partial = 0
+		self.reused = 0
+		self._state = {}
+	
+	def changes(self, state, coeff1, coeff2, strip):
+		"""
+		Measure the change of a subband since its weights were computed
+		
+		state 	- the state of the subband
+		coeff1 	- coefficient of the RGB image
+		coeff2 	- coefficient of the IR image
+		strip 	- the height of the strips, in coefficients
+		
+		
+		Return the relative change of each strip (of its block that changed the most), and the
+		relative change of the median block
+		"""
+		difference = np.abs(coeff1 - state["reference1"])
+		difference += np.abs(coeff2 - state["reference2"])
+		difference = difference.reshape(difference.shape[:2] + (-1,)).mean(axis=2)
+		
+		# Mean of the blocks (the last ones being smaller), over every coefficient so that the
+		# change of a single row or column of coefficients is seen
+		rows = np.arange(0, difference.shape[0], BLOCK)
+		columns = np.arange(0, difference.shape[1], BLOCK)
+		blocks = np.add.reduceat(np.add.reduceat(difference, rows, axis=0), columns, axis=1)
+		blocks /= np.outer(np.diff(np.append(rows, difference.shape[0])), np.diff(np.append(columns, difference.shape[1])))
+		
+		median = np.median(blocks)
+		if state["noise"] is None:
+			state["noise"] = median
+		
+		strips = np.maximum.reduceat(blocks.max(axis=1), np.arange(0, len(rows), strip // BLOCK))
+		return (strips - state["noise"]) / state["scale"], (median - state["noise"]) / state["scale"]
+	
+	def computeStrips(self, state, coeff1, coeff2, strips, strip):
+		"""
+		Compute again the weights of some strips of a subband, with the margin the
+		neighborhood of the strategy needs
+		"""
+		rows = coeff1.shape[0]
+		arrays = weightArrays(state["weights"])
+		# Number of rows of coefficients per row of weights (the windows of Deviation)
+		ratio = -(-rows // arrays[0].shape[0])
+		margin = int(math.ceil(self.strategy.neighborhood / 2. / ratio)) * ratio
+		
+		for s in strips:
+			r0, r1 = s * strip, min(rows, (s + 1) * strip)
+			m0, m1 = max(0, r0 - margin), min(rows, r1 + margin)
+			
+			weights = weightArrays(self.strategy.weights(coeff1[m0:m1], coeff2[m0:m1]))
+			for cached, new in zip(arrays, weights):
+				cached[r0 // ratio:-(-r1 // ratio)] = new[(r0 - m0) // ratio:(r0 - m0) // ratio + -(-r1 // ratio) - r0 // ratio]
+			
+			state["reference1"][r0:r1] = coeff1[r0:r1]
+			state["reference2"][r0:r1] = coeff2[r0:r1]
+	
+	def fuseSubband(self, key, coeff1, coeff2, full = False):
+		"""
+		Fuse a subband, reusing the weights of the previous frames where it has not changed
+		
+		key 	- the subband, (level, name)
+		coeff1 	- coefficient of the RGB image
+		coeff2 	- coefficient of the IR image
+		full 	- compute all the weights in any case
+		
+		
+		Return fused coefficient
+		"""
+		strategy = self.strategy
+		
+		if strategy.weights is None or coeff1.dtype not in strategy.dtypes or (strategy.global_stats and not self.global_stats):
+			return strategy(coeff1, coeff2)
+		
+		state = self._state.get(key)
+		
+		if full or state is None or state["shape"] != coeff1.shape:
+			state = {
+				"shape" 		: coeff1.shape,
+				"weights" 		: strategy.weights(coeff1, coeff2),
+				"reference1" 	: coeff1.copy(),
+				"reference2" 	: coeff2.copy(),
+				"scale" 		: np.abs(coeff1 - coeff1.mean()).mean() + np.abs(coeff2 - coeff2.mean()).mean() + np.finfo(np.float32).eps,
+				"noise" 		: state["noise"] if state is not None and state["shape"] == coeff1.shape else None,
+			}
+			self._state[key] = state
+			self.computed += 1
+		else:
+			arrays = weightArrays(state["weights"])
+			# The strips hold whole rows of weights and whole blocks
+			ratio = -(-coeff1.shape[0] // arrays[0].shape[0]) if arrays else 1
+			step = ratio * BLOCK // math.gcd(ratio, BLOCK)
+			strip = max(step, STRIP // step * step)
+			
+			strips, median = self.changes(state, coeff1, coeff2, strip)
+			changed = np.flatnonzero(strips > self.threshold)
+			
+			if len(changed) == 0:
+				self.reused += 1
+			elif strategy.global_stats or not arrays or median > self.threshold:
+				return self.fuseSubband(key, coeff1, coeff2, True)
+			else:
+				self.computeStrips(state, coeff1, coeff2, changed, strip)
+				self.partial += 1
+		
+		return strategy.combine(coeff1, coeff2, state["weights"])
+	
+	def fuseCoefficients(self, coeff1, coeff2):
+		"""
+		Apply the fusion strategy to every level of the decompositions of the next frame
+		
+		coeff1 - the decomposition of the RGB frame
+		coeff2 - the decomposition of the IR frame
+		
+		
+		Return fused decomposition
+		"""
+		full = bool(self.refresh) and self.frames % self.refresh == 0
+		self.frames += 1
+		
+		fused = [self.fuseSubband((len(coeff1) - 1, "cA"), coeff1[0], coeff2[0], full)]
+		for i in range(1, len(coeff1)):
+			level = len(coeff1) - i
+			fused.append(tuple(self.fuseSubband((level, name), coeff1[i][k], coeff2[i][k], full)
+							   for k, name in enumerate(("cH", "cV", "cD"))))
+		
+		return fused
+	
+	def fuse(self, I1, I2):
+		"""
+		Fuse the next frame of the sequence
+		
+		I1 - the RGB frame
+		I2 - the IR frame
+		
+		
+		Return fused image
+		"""
+		if self.color is not None:
+			converted, I1, I2 = luminance(I1, I2, self.color)
+		
+		coeff1 = decompose(I1, self.wavelet, self.level, self.dtype)
+		coeff2 = decompose(I2, self.wavelet, self.level, self.dtype)
+		fused = normalize(reconstruct(self.fuseCoefficients(coeff1, coeff2), self.wavelet, I1.shape[:2]))
+		
+		return fused if self.color is None else colorize(converted, fused, self.color)
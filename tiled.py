@@ -0,0 +1,151 @@
+import argparse
+import math
+import os
+import tempfile
+
+import numpy as np
+from pywt import Wavelet, wavelist, families
+from fuse import decompose, fuseCoefficients, reconstruct, normalize, LEVEL
+from main import STRATEGIES
+from strategies import REGISTRY, getStrategy
+
+# Largest neighborhood of the registered strategies, in coefficients (the match
+# window of MACD, 5 x 5)
+NEIGHBORHOOD = max(strategy.neighborhood for strategy in REGISTRY.values())
+
+def tileAlignment(level = LEVEL, neighborhood = NEIGHBORHOOD):
+	"""
+	Return the alignment of the tiles, in pixels. Tiles starting on multiples of it
+	have their coefficients (and the windows of Deviation) on the same grid as the
+	whole image at every level of decomposition.
+	"""
+	return max(1, neighborhood) * 2**level
+
+def tileMargin(wavelet = 'db', level = LEVEL, neighborhood = NEIGHBORHOOD):
+	"""
+	Compute the overlap needed around a tile so that its fused pixels are the same as
+	if the whole image was fused at once
+
+	wavelet 		- the wavelet family to use
+	level 			- the number of decomposition levels
+	neighborhood 	- the size of the neighborhood of the strategy, in coefficients
+
+
+	Return the margin, in pixels, on each side of the tiles
+	"""
+	filter_length = Wavelet(wavelist(wavelet)[0]).dec_len
+	align = tileAlignment(level, neighborhood)
+
+	# A coefficient of the last level depends on (filter_length - 1) * 2^level pixels,
+	# and the strategies look at neighborhood coefficients around it
+	margin = (filter_length - 1 + neighborhood) * 2**level
+
+	return int(math.ceil(margin / float(align))) * align
+
+def tiles(shape, tile_size):
+	"""
+	Divide an image into tiles
+
+	shape 		- the shape of the image
+	tile_size 	- the size of the tiles
+
+
+	Return a generator of the tiles (row_start, row_end, column_start, column_end)
+	"""
+	for r in range(0, shape[0], tile_size):
+		for c in range(0, shape[1], tile_size):
+			yield (r, min(r + tile_size, shape[0]), c, min(c + tile_size, shape[1]))
+
+def fuseTiled(I1, I2, output, FUSION_METHOD, wavelet = 'db', tile_size = 2048, level = LEVEL, tmpdir = None, dtype = None):
+	"""
+	Fusion algorithm using wavelets, tile by tile, for images that do not fit in memory.
+	Each tile is fused with a margin sized to the wavelet, the decomposition levels and the
+	neighborhood of the strategy, so that the result is the same as fusedImage for the
+	strategies that are elementwise or local (Mean, Min, Max, Deviation), whatever the size
+	of the images. The strategies registered with global_stats (Entropy, Edge, MACD) use
+	statistics of the whole subbands, which are computed per tile here.
+
+	The fused tiles are first stored as floats in a temporary file, then normalized with
+	the minimum and maximum of the whole image, one tile at a time.
+
+	I1				- the first image, e.g. a np.memmap or np.load(path, mmap_mode='r')
+	I2				- the second image, same shape as I1
+	output 			- the fused image, a uint8 array of the same shape as I1 (e.g. a np.memmap),
+					  or the path of the .npy file to create
+	FUSION_METHOD	- the fusion strategy to apply to the coefficients
+	wavelet 		- the wavelet to use
+	tile_size 		- the size of the tiles, rounded up to the alignment of the tiles
+	level 			- the number of decomposition levels
+	tmpdir 			- the directory of the temporary file (default : the directory of output)
+	dtype 			- the precision of the computations and of the temporary file, np.float32
+					  for single precision (default : double precision)
+
+
+	Return fused image (the output array)
+	"""
+	if I1.shape != I2.shape:
+		raise ValueError("the images must have the same shape, got %s and %s" % (I1.shape, I2.shape))
+
+	if isinstance(output, str):
+		tmpdir = tmpdir or os.path.dirname(os.path.abspath(output))
+		output = np.lib.format.open_memmap(output, mode='w+', dtype=np.uint8, shape=I1.shape)
+
+	neighborhood = getStrategy(FUSION_METHOD).neighborhood
+	align = tileAlignment(level, neighborhood)
+	tile_size = int(math.ceil(tile_size / float(align))) * align
+	margin = tileMargin(wavelet, level, neighborhood)
+	h, w = I1.shape[:2]
+
+	fd, raw_path = tempfile.mkstemp(suffix='.npy', dir=tmpdir)
+	os.close(fd)
+
+	try:
+		raw = np.lib.format.open_memmap(raw_path, mode='w+', dtype=dtype or np.float64, shape=I1.shape)
+		low, high = np.inf, -np.inf
+
+		for r0, r1, c0, c1 in tiles(I1.shape, tile_size):
+			# Tile and its margin, clipped to the image (the image borders are then
+			# extended by the wavelet transform exactly as for the whole image)
+			s0, e0 = max(0, r0 - margin), min(h, r1 + margin)
+			s1, e1 = max(0, c0 - margin), min(w, c1 + margin)
+
+			coeff1 = decompose(np.asarray(I1[s0:e0, s1:e1]), wavelet, level, dtype)
+			coeff2 = decompose(np.asarray(I2[s0:e0, s1:e1]), wavelet, level, dtype)
+			# The coefficients of the tile are not reused : in place strategies write to them
+			fused = reconstruct(fuseCoefficients(coeff1, coeff2, FUSION_METHOD, overwrite=True), wavelet)
+
+			tile = fused[r0 - s0:r1 - s0, c0 - s1:c1 - s1]
+			raw[r0:r1, c0:c1] = tile
+			low, high = min(low, tile.min()), max(high, tile.max())
+
+			del coeff1, coeff2, fused, tile
+
+		raw.flush()
+
+		for r0, r1, c0, c1 in tiles(I1.shape, tile_size):
+			output[r0:r1, c0:c1] = normalize(raw[r0:r1, c0:c1], low, high)
+
+		if isinstance(output, np.memmap):
+			output.flush()
+
+		del raw
+	finally:
+		os.remove(raw_path)
+
+	return output
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Fuse very large images tile by tile (.npy files, memory mapped)")
+	parser.add_argument('rgb', help="RGB image (.npy)")
+	parser.add_argument('ir', help="IR image (.npy), same shape as the RGB image")
+	parser.add_argument('output', help="fused image (.npy)")
+	parser.add_argument('-s', '--strategy', default='Mean', choices=STRATEGIES)
+	parser.add_argument('-w', '--wavelet', default='db', choices=families()[:7])
+	parser.add_argument('-t', '--tile-size', type=int, default=2048, help="size of the tiles, in pixels")
+	parser.add_argument('-f', '--float32', action='store_true', help="fuse in single precision")
+	args = parser.parse_args()
+
+	I1 = np.load(args.rgb, mmap_mode='r')
+	I2 = np.load(args.ir, mmap_mode='r')
+
+	fuseTiled(I1, I2, args.output, args.strategy, args.wavelet, args.tile_size, dtype=np.float32 if args.float32 else None)
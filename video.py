@@ -0,0 +1,247 @@
+import argparse
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from queue import Queue
+
+import cv2
+import numpy as np
+from pywt import families
+from fuse import fusedImage, COLOR_SPACES
+from main import STRATEGIES
+from registration import TRANSFORMS, TransformCache, estimateTransform, warp
+from temporal import TemporalFusion
+
+def readFrames(rgb_capture, ir_capture, queue, align = None):
+	"""
+	Decode the frames of both streams and put the pairs in the queue, until one of
+	the streams ends. None is put in the queue at the end, or the exception raised by
+	the decoding or the registration of a pair, for the consumer to raise it.
+	
+	rgb_capture - the cv2.VideoCapture of the RGB stream
+	ir_capture 	- the cv2.VideoCapture of the IR stream
+	queue 		- the (bounded) queue of the pairs of frames
+	align 		- a function registering the IR frame onto the RGB frame, called as
+				  align(I1, I2) (default : the IR frame is resized to the RGB frame)
+	"""
+	end = None
+	try:
+		while True:
+			ok1, I1 = rgb_capture.read()
+			ok2, I2 = ir_capture.read()
+			
+			if not (ok1 and ok2):
+				break
+			
+			# The streams are synchronized, but the sensors may not have the same resolution
+			if align is not None:
+				I2 = align(I1, I2)
+			elif I2.shape[:2] != I1.shape[:2]:
+				I2 = cv2.resize(I2, (I1.shape[1], I1.shape[0]))
+			
+			queue.put((I1, I2))
+	except Exception as e:
+		end = e
+	finally:
+		queue.put(end)
+
+def writeFrames(writer, queue):
+	"""
+	Encode the fused frames of the queue, until None is received
+	
+	writer 	- the cv2.VideoWriter of the output
+	queue 	- the (bounded) queue of the fused frames
+	"""
+	while True:
+		frame = queue.get()
+		
+		if frame is None:
+			break
+		
+		writer.write(frame)
+
+# TemporalFusion of each worker process
+_temporal = {}
+
+def fuseFrame(I1, I2, strategy, wavelet, dtype = None, temporal = None, color = None):
+	"""
+	Fuse a pair of frames. Runs in the worker processes.
+	
+	temporal - (threshold, refresh, global_stats) to reuse the weights of the strategy from
+			   the previous frames fused by the process (see temporal.TemporalFusion) (optional)
+	color 	 - the color space of the luminance fusion, "ycrcb" or "hsv" (optional)
+	
+	
+	Return the fused frame, cropped to the size of the input frames
+	"""
+	if temporal:
+		key = (strategy, wavelet, dtype, temporal, color)
+		if key not in _temporal:
+			_temporal[key] = TemporalFusion(strategy, wavelet, threshold=temporal[0], refresh=temporal[1], dtype=dtype, color=color,
+											global_stats=temporal[2])
+		return _temporal[key].fuse(I1, I2)[:I1.shape[0], :I1.shape[1]]
+	
+	return fusedImage(I1, I2, strategy, wavelet, dtype, color=color)[:I1.shape[0], :I1.shape[1]]
+
+def fuseVideo(rgb_source, ir_source, output_path, strategy = "Mean", wavelet = 'db',
+			  workers = None, queue_size = 8, fourcc = 'mp4v', fps = None, report = 100, dtype = None,
+			  register = None, transforms = None, temporal = None, color = None):
+	"""
+	Fuse two synchronized video streams frame by frame. Decoding, fusion and encoding
+	are pipelined : one thread decodes both streams, a pool of processes fuses the
+	frames and one thread encodes the output, connected by bounded queues.
+	
+	rgb_source 	- the RGB stream, a video file or an image sequence (e.g. 'rgb/IMG_%04d.jpg')
+	ir_source 	- the IR stream, a video file or an image sequence
+	output_path - the output video
+	strategy 	- the fusion strategy to apply
+	wavelet 	- the wavelet to use
+	workers 	- the number of fusion processes (default : the number of CPUs)
+	queue_size 	- the number of frames each queue can hold
+	fourcc 		- the codec of the output video
+	fps 		- the frame rate of the output (default : the frame rate of the RGB stream)
+	report 		- the number of frames between two progress reports
+	dtype 		- the precision of the fusion, np.float32 for single precision
+				  (default : double precision)
+	register 	- the kind of transform registering the IR stream onto the RGB stream :
+				  "translation", "rigid" or "similarity". The transform is estimated on
+				  the first frames only (default : the IR frames are only resized)
+	transforms 	- the registration.TransformCache of the rigs, the transform of the IR
+				  stream being reused from it if it holds one (optional)
+	temporal 	- (threshold, refresh, global_stats) to reuse the weights of the strategy of the
+				  previous frames (see temporal.TemporalFusion). Each process then fuses every
+				  workers-th frame, so that the frames it sees follow each other (optional)
+	color 		- the color space of the luminance fusion, "ycrcb" or "hsv" : only the
+				  luminance of the RGB frames is fused with the IR frames, a third of the
+				  work (default : the BGR channels are fused)
+	
+	
+	Return a dict {"frames", "seconds", "fps"} with the number of frames fused and
+	the sustained frame rate of the whole pipeline
+	"""
+	rgb_capture = cv2.VideoCapture(rgb_source)
+	ir_capture = cv2.VideoCapture(ir_source)
+	
+	if not (rgb_capture.isOpened() and ir_capture.isOpened()):
+		raise IOError("cannot open " + (rgb_source if not rgb_capture.isOpened() else ir_source))
+	
+	fps = fps or rgb_capture.get(cv2.CAP_PROP_FPS) or 25
+	workers = workers or os.cpu_count()
+	
+	read_queue = Queue(queue_size)
+	write_queue = Queue(queue_size)
+	
+	align = None
+	if register:
+		transforms = transforms or TransformCache()
+		
+		def align(I1, I2):
+			# The rig does not move : the transform of the first frames is used for all
+			if transforms.get(ir_source) is None:
+				transforms.put(ir_source, estimateTransform(I1, I2, register))
+			return warp(I2, transforms.get(ir_source), I1.shape)
+	
+	reader = threading.Thread(target=readFrames, args=(rgb_capture, ir_capture, read_queue, align), daemon=True)
+	reader.start()
+	
+	writer = None
+	encoder = None
+	frames = 0
+	time_start = time.time()
+	
+	def __write(frame):
+		nonlocal writer, encoder, frames
+		
+		# The writer is only created once the size of the fused frames is known
+		if writer is None:
+			writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*fourcc), fps,
+									 (frame.shape[1], frame.shape[0]), frame.ndim == 3)
+			encoder = threading.Thread(target=writeFrames, args=(writer, write_queue), daemon=True)
+			encoder.start()
+		
+		write_queue.put(frame)
+		frames += 1
+		
+		if report and frames % report == 0:
+			print("%d frames fused, %.2f fps" % (frames, frames / (time.time() - time_start)))
+	
+	try:
+		with ExitStack() as stack:
+			# With temporal reuse, frame n always goes to the process n % workers, so
+			# that each process keeps the weights of the frames it fused before
+			if temporal:
+				executors = [stack.enter_context(ProcessPoolExecutor(max_workers=1)) for _ in range(workers)]
+			else:
+				executors = [stack.enter_context(ProcessPoolExecutor(max_workers=workers))]
+			
+			# At most max(workers, queue_size) frames are fused at the same time,
+			# and they are written in the order they were read
+			pending = deque()
+			n = 0
+			
+			while True:
+				pair = read_queue.get()
+				
+				if pair is None:
+					break
+				# An error of the reader thread fails the video, instead of ending it early
+				if isinstance(pair, Exception):
+					raise pair
+				
+				executor = executors[n % len(executors)]
+				pending.append(executor.submit(fuseFrame, pair[0], pair[1], strategy, wavelet, dtype, temporal, color))
+				n += 1
+				
+				if len(pending) >= max(workers, queue_size):
+					__write(pending.popleft().result())
+			
+			while pending:
+				__write(pending.popleft().result())
+	finally:
+		if encoder is not None:
+			write_queue.put(None)
+			encoder.join()
+			writer.release()
+		
+		rgb_capture.release()
+		ir_capture.release()
+	
+	seconds = time.time() - time_start
+	
+	return {"frames" : frames, "seconds" : seconds, "fps" : frames / seconds if seconds else 0.}
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Fuse synchronized RGB and IR video streams")
+	parser.add_argument('rgb', help="RGB video file or image sequence (e.g. rgb/IMG_%%04d.jpg)")
+	parser.add_argument('ir', help="IR video file or image sequence")
+	parser.add_argument('output', help="fused video file")
+	parser.add_argument('-s', '--strategy', default='Mean', choices=STRATEGIES)
+	parser.add_argument('-w', '--wavelet', default='db', choices=families()[:7])
+	parser.add_argument('-j', '--workers', type=int, default=None, help="number of fusion processes (default : number of CPUs)")
+	parser.add_argument('-q', '--queue-size', type=int, default=8, help="number of frames each queue can hold")
+	parser.add_argument('--fourcc', default='mp4v', help="codec of the output video")
+	parser.add_argument('-f', '--float32', action='store_true', help="fuse in single precision")
+	parser.add_argument('--color', default=None, choices=list(COLOR_SPACES),
+						help="fuse the luminance of the RGB frames in this color space with the IR frames, keeping the colors")
+	parser.add_argument('-r', '--register', default=None, choices=list(TRANSFORMS),
+						help="register the IR stream onto the RGB stream, the transform being estimated on the first frames")
+	parser.add_argument('--transforms', default=None, help="JSON file of the transforms of the rigs, reused between runs")
+	parser.add_argument('-t', '--temporal', type=float, default=None,
+						help="reuse the weights of the strategy while the subbands change by less than this fraction (e.g. 0.5)")
+	parser.add_argument('--refresh', type=int, default=30, help="frames between two full computations of the weights, with --temporal")
+	parser.add_argument('--temporal-global', action='store_true',
+						help="with --temporal, reuse the weights of Entropy, Edge and MACD too, which changes the fused frames")
+	parser.add_argument('--fps', type=float, default=None, help="frame rate of the output (default : frame rate of the RGB stream)")
+	args = parser.parse_args()
+	
+	stats = fuseVideo(args.rgb, args.ir, args.output, args.strategy, args.wavelet,
+					  args.workers, args.queue_size, args.fourcc, args.fps,
+					  dtype=np.float32 if args.float32 else None, register=args.register,
+					  transforms=TransformCache(args.transforms) if args.transforms else None,
+					  temporal=(args.temporal, args.refresh, args.temporal_global) if args.temporal is not None else None,
+					  color=args.color)
+	
+	print("%d frames fused in %.2fs : %.2f fps" % (stats["frames"], stats["seconds"], stats["fps"]))